@@ -0,0 +1,933 @@
+#!/usr/bin/env python
+
+'''Benchmarks for the XML parser
+
+Usage: benchmark.py [name ...]
+
+Runs every benchmark when no name is given.
+'''
+
+import os
+import gc
+import sys
+import glob
+import time
+import types
+import shutil
+import resource
+import tempfile
+import subprocess
+from UserString import UserString
+from StringIO import StringIO
+
+import parser
+
+
+################################
+# HELPERS
+
+def _best_time(func, number, repeat=3):
+    'Returns the best time, in seconds, of calling func() number times'
+
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for j in xrange(number):
+            func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def _generate(records):
+    'Returns a generated document with the given number of records'
+
+    record = (
+        '  <Product pid="p%d">\n'
+        '    <Name>gizmo</Name>\n'
+        '    <Price currency=\'USD\'>22.99</Price>\n'
+        '    <Description>great</Description>\n'
+        '  </Product>\n'
+    )
+    return '<Products>\n' + ''.join([record % i for i in xrange(records)]) + '</Products>\n'
+
+def _deep_size(obj):
+    'Returns the size of obj and of all the objects it refers to, in bytes'
+
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (type, types.ClassType, types.ModuleType)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+
+    return size
+
+def _count_nodes(root):
+    'Returns the number of elements and text nodes in a document tree'
+
+    count = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        count += 1
+        if isinstance(node, parser.DOM.Element):
+            stack.extend(node.children)
+
+    return count
+
+def _cold_time(statement, setup='pass', repeat=5):
+    'Returns the best time, in seconds, of running statement in a new process'
+
+    script = (
+        'import time\n'
+        '%s\n'
+        'start = time.time()\n'
+        '%s\n'
+        'print time.time() - start\n'
+    ) % (setup, statement)
+
+    best = None
+    for i in range(repeat):
+        output = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE).communicate()[0]
+        elapsed = float(output.split()[-1])
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def _samples():
+    for path in sorted(glob.glob('samples/*.xml')):
+        yield path, open(path).read()
+
+
+################################
+# BENCHMARKS
+
+def bench_reuse():
+    'Per-document cost of rebuilding the parser vs. reusing an XmlParser'
+
+    number = 200
+    xml_parser = parser.XmlParser()
+
+    print '%-24s %6s %16s %16s %8s' % ('file', 'bytes', 'rebuild (us)', 'reuse (us)', 'speedup')
+    for path, data in _samples():
+        t_rebuild = _best_time(lambda: parser.XmlParser().parse(data), number) / number
+        t_reuse = _best_time(lambda: xml_parser.parse(data), number) / number
+        print '%-24s %6d %16.1f %16.1f %7.1fx' % (path, len(data), t_rebuild * 1e6, t_reuse * 1e6, t_rebuild / t_reuse)
+
+
+def bench_trace():
+    'Reductions per second with tracing disabled, before and after'
+
+    data = _generate(200)
+    number = 5
+
+    # Count the reductions
+    counter = [0]
+    def counted(func):
+        def counted_func(p):
+            counter[0] += 1
+            func(p)
+        return counted_func
+
+    def legacy_traced(func):
+        # The per-reduction cost of the former _parser_trace() calls
+        def legacy_func(p):
+            parser._debug_print_('PARSER', '[%-16s] %s' % (sys._getframe(0).f_code.co_name, 'YaccP%s' % [i.value for i in p.slice]))
+            func(p)
+        return legacy_func
+
+    def wrapped_parser(wrapper):
+        xml_parser = parser.XmlParser()
+        for production in xml_parser.parser.productions:
+            if production.callable:
+                production.callable = wrapper(production.callable)
+        return xml_parser
+
+    wrapped_parser(counted).parse(data)
+    reductions = counter[0]
+
+    before = wrapped_parser(legacy_traced)
+    after = parser.XmlParser()
+
+    t_before = _best_time(lambda: before.parse(data), number) / number
+    t_after = _best_time(lambda: after.parse(data), number) / number
+    print '%d bytes, %d reductions per document' % (len(data), reductions)
+    print '%-8s %14.0f reductions/s' % ('before', reductions / t_before)
+    print '%-8s %14.0f reductions/s' % ('after', reductions / t_after)
+
+
+def bench_siblings():
+    'Parse time and parser stack depth vs. the number of sibling elements'
+
+    xml_parser = parser.XmlParser()
+    lexer = xml_parser.xml_lexer.lexer
+
+    print '%8s %10s %12s %12s %10s' % ('siblings', 'bytes', 'total (ms)', 'per item (us)', 'max stack')
+    for siblings in (1000, 10000, 100000):
+        data = '<list>' + '<item id="1">x</item>' * siblings + '</list>'
+
+        # Sample the depth of the symbol stack every time a token is read
+        depth = [0]
+        def token():
+            depth[0] = max(depth[0], len(xml_parser.parser.symstack))
+            return lexer.token()
+
+        xml_parser.xml_lexer.input(data)
+        start = time.time()
+        xml_parser.parser.parse(lexer=lexer, tokenfunc=token)
+        elapsed = time.time() - start
+        print '%8d %10d %12.1f %12.2f %10d' % (siblings, len(data), elapsed * 1e3, elapsed / siblings * 1e6, depth[0])
+
+
+def bench_events():
+    'Building the document tree vs. reporting events to a ContentHandler'
+
+    data = _generate(1000)
+    number = 3
+
+    class Counter(parser.ContentHandler):
+        def __init__(self):
+            self.elements = 0
+        def start_element(self, name, attributes):
+            self.elements += 1
+
+    dom_parser = parser.XmlParser()
+    event_parser = parser.XmlParser(Counter())
+
+    t_dom = _best_time(lambda: dom_parser.parse(data), number) / number
+    t_events = _best_time(lambda: event_parser.parse(data), number) / number
+    print '%d bytes' % len(data)
+    print '%-8s %10.1f ms %10.2f MB/s' % ('tree', t_dom * 1e3, len(data) / t_dom / 1e6)
+    print '%-8s %10.1f ms %10.2f MB/s' % ('events', t_events * 1e3, len(data) / t_events / 1e6)
+
+
+def bench_iterparse():
+    'Record-oriented processing with iterparse() and clear()'
+
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    os.write(fd, _generate(5000))
+    os.close(fd)
+
+    try:
+        start = time.time()
+        root = None
+        records = 0
+        for event, element in parser.iterparse(path):
+            if event == 'start':
+                if root is None:
+                    root = element
+            elif element.name == 'Product':
+                records += 1
+                root.clear()
+        elapsed = time.time() - start
+    finally:
+        os.remove(path)
+
+    print '%d records in %.2f s, %.0f records/s' % (records, elapsed, records / elapsed)
+    print '%d children left under the root' % len(root.children)
+
+
+class _LegacyElement:
+    # The former DOM.Element, an old-style class with a __dict__
+    def __init__(self, name, attributes={}, children=[]):
+        self.name = name
+        self.attributes = attributes
+        self.children = children
+
+class _LegacyPcdata(UserString):
+    pass
+
+def _legacy_tree(element):
+    'Returns a copy of a document tree using the former node classes'
+
+    attributes = dict(element.attributes)
+    if not element.children:
+        return _LegacyElement(element.name, attributes)
+
+    children = []
+    for child in element.children:
+        if isinstance(child, parser.DOM.Element):
+            children.append(_legacy_tree(child))
+        else:
+            # Every token value used to be a distinct string
+            children.append(_LegacyPcdata(child[:1] + child[1:]))
+    return _LegacyElement(element.name[:1] + element.name[1:], attributes, children)
+
+def bench_memory():
+    'Memory per node of the document tree, before and after'
+
+    xml_parser = parser.XmlParser()
+
+    print '%8s %10s %14s %14s' % ('records', 'nodes', 'before (B/node)', 'after (B/node)')
+    for records in (100, 1000, 10000):
+        root = xml_parser.parse(_generate(records))
+        nodes = _count_nodes(root)
+        before = _deep_size(_legacy_tree(root))
+        after = _deep_size(root)
+        print '%8d %10d %14.1f %14.1f' % (records, nodes, float(before) / nodes, float(after) / nodes)
+
+
+def bench_store():
+    'Memory per node and scan time of a DocumentStore vs. DOM.Element trees'
+
+    dom_parser = parser.XmlParser()
+    store_parser = parser.XmlParser(store=True)
+
+    def dom_scan(root, name):
+        count = 0
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node.name == name:
+                count += 1
+            stack.extend([child for child in node.children if isinstance(child, parser.DOM.Element)])
+        return count
+
+    def store_scan(store, name):
+        count = 0
+        for element in store.elements(name):
+            count += 1
+        return count
+
+    print '%8s %10s %14s %14s %14s %12s %12s' % ('records', 'nodes', 'legacy (B/node)', 'DOM (B/node)',
+                                                 'store (B/node)', 'DOM scan (ms)', 'store scan (ms)')
+    for records in (100, 1000, 10000):
+        data = _generate(records)
+        root = dom_parser.parse(data)
+        store = store_parser.parse(data).store
+        nodes = len(store)
+
+        legacy = _deep_size(_legacy_tree(root))
+        dom = _deep_size(root)
+        # The input data is not part of the cost of the store
+        stored = _deep_size(store) - sys.getsizeof(data)
+
+        t_dom_scan = _best_time(lambda: dom_scan(root, 'Price'), 1)
+        t_store = _best_time(lambda: store_scan(store, 'Price'), 1)
+        print '%8d %10d %14.1f %14.1f %14.1f %12.1f %12.1f' % (records, nodes, float(legacy) / nodes, float(dom) / nodes,
+                                                           float(stored) / nodes, t_dom_scan * 1e3, t_store * 1e3)
+
+
+def bench_spans():
+    'Input bytes copied into token values, with and without spans'
+
+    text = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 100
+    data = '<doc>' + ('<p class="text">%s</p>' % text) * 500 + '</doc>'
+
+    print '%d bytes' % len(data)
+    for spans in (False, True):
+        xml_lexer = parser.XmlLexer()
+        xml_lexer.build()
+        if spans:
+            xml_lexer.use_spans()
+
+        def copied():
+            xml_lexer.input(data)
+            total = 0
+            while 1:
+                tok = xml_lexer.lexer.token()
+                if not tok: break
+                if tok.value is not None:
+                    total += len(tok.value)
+            return total
+
+        elapsed = _best_time(copied, 1)
+        print '%-8s %10d bytes copied %10.1f ms' % (spans and 'spans' or 'values', copied(), elapsed * 1e3)
+
+
+def bench_mmap():
+    'Time to the first token when reading vs. memory-mapping the input file'
+
+    xml_lexer = parser.XmlLexer()
+    xml_lexer.build()
+
+    print '%10s %14s %14s' % ('bytes', 'read (ms)', 'mmap (ms)')
+    for records in (1000, 10000, 100000):
+        fd, path = tempfile.mkstemp(suffix='.xml')
+        os.write(fd, _generate(records))
+        os.close(fd)
+
+        def first_token(load):
+            xml_lexer.input(load(path))
+            return xml_lexer.lexer.token()
+
+        try:
+            t_read = _best_time(lambda: first_token(lambda path: open(path).read()), 1)
+            t_mmap = _best_time(lambda: first_token(parser._map_file), 1)
+            print '%10d %14.2f %14.2f' % (os.path.getsize(path), t_read * 1e3, t_mmap * 1e3)
+        finally:
+            os.remove(path)
+
+
+def bench_lexcache():
+    'Cold start of the XmlLexer, with and without a lexer cache'
+
+    cachedir = tempfile.mkdtemp()
+    statement = 'parser.XmlLexer().build(cachedir=%r)'
+
+    # The build alone, and the build with the imports, which include the
+    # modules loaded for the cache
+    try:
+        for label, setup, prefix in [('build', 'import parser', ''),
+                                     ('import and build', 'pass', 'import parser; ')]:
+            t_build = _cold_time(prefix + statement % None, setup)
+            t_cached = _cold_time(prefix + statement % cachedir, setup)
+            print '%s:' % label
+            print '    %-12s %10.2f ms' % ('no cache', t_build * 1e3)
+            print '    %-12s %10.2f ms' % ('cached', t_cached * 1e3)
+    finally:
+        shutil.rmtree(cachedir)
+
+
+def _synthetic_grammar(path, size):
+    'Writes a grammar module with size chained nonterminals to path'
+
+    out = open(path, 'w')
+    out.write('tokens = %r\n\n' % ['T%d' % i for i in range(size)])
+    out.write('def p_start(p):\n    "start : n0"\n\n')
+    for i in range(size - 1):
+        out.write('def p_n%d(p):\n    """n%d : n%d T%d n%d\n          | T%d n%d\n          | T%d"""\n\n'
+                  % (i, i, i, i, i + 1, i, i + 1, i))
+    out.write('def p_n%d(p):\n    "n%d : T0"\n\n' % (size - 1, size - 1))
+    out.write('def p_error(p):\n    pass\n')
+    out.close()
+
+def bench_dense():
+    'Parse throughput on samples scaled to 1 MB, with hashed and dense tables'
+
+    hashed_parser = parser.XmlParser()
+    dense_parser = parser.XmlParser()
+    dense_parser.parser.use_dense_tables()
+
+    print '%-24s %8s %14s %14s %8s' % ('file', 'MB', 'hashed (MB/s)', 'dense (MB/s)', 'speedup')
+    for path, data in _samples():
+        scaled = '<Samples>%s</Samples>' % (data * (1024 * 1024 // len(data)))
+        megabytes = len(scaled) / (1024.0 * 1024)
+        t_hashed = _best_time(lambda: hashed_parser.parse(scaled), 1)
+        t_dense = _best_time(lambda: dense_parser.parse(scaled), 1)
+        print '%-24s %8.1f %14.2f %14.2f %7.2fx' % (path, megabytes, megabytes / t_hashed,
+                                                     megabytes / t_dense, t_hashed / t_dense)
+
+def bench_specialized():
+    'Parser alone, generic parseopt_notrack() vs. a module written by write_module()'
+
+    tmpdir = tempfile.mkdtemp()
+    xml_parser = parser.XmlParser()
+    xml_parser.parser.write_module('xmlparser_specialized', tmpdir)
+    sys.path.insert(0, tmpdir)
+    try:
+        import xmlparser_specialized
+        specialized_parse = xmlparser_specialized.bind(xml_parser.parser)
+    finally:
+        del sys.path[0]
+        shutil.rmtree(tmpdir)
+
+    lexer = xml_parser.xml_lexer
+    print '%-24s %8s %14s %14s %8s' % ('file', 'tokens', 'generic (ms)', 'special (ms)', 'speedup')
+    for path, data in _samples():
+        scaled = '<Samples>%s</Samples>' % (data * (256 * 1024 // len(data)))
+
+        # The tokens are read once, so that only the parser is timed
+        lexer.input(scaled)
+        tokens = list(iter(lexer.lexer.token, None))
+        def replay():
+            return iter(tokens + [None]).next
+
+        generic = xml_parser.parser.parseopt_notrack(lexer=lexer.lexer, tokenfunc=replay())
+        assert parser.equal_trees(specialized_parse(lexer.lexer, replay()), generic)
+
+        t_generic = _best_time(lambda: xml_parser.parser.parse(lexer=lexer.lexer, tokenfunc=replay()), 1)
+        t_special = _best_time(lambda: specialized_parse(lexer.lexer, replay()), 1)
+        print '%-24s %8d %14.1f %14.1f %7.2fx' % (path, len(tokens), t_generic * 1e3, t_special * 1e3,
+                                                   t_generic / t_special)
+
+def bench_reduce():
+    'YaccSymbols allocated per reduction, slicing (parseopt) vs. in place (parseopt_notrack)'
+
+    from ply import yacc
+
+    data = _generate(200)
+    xml_parser = parser.XmlParser()
+
+    # Count the reductions and the symbols allocated by the parser
+    counter = {'reductions': 0, 'symbols': 0}
+    class CountedSymbol(yacc.YaccSymbol):
+        def __init__(self):
+            counter['symbols'] += 1
+    def counted(func):
+        def counted_func(p):
+            counter['reductions'] += 1
+            func(p)
+        return counted_func
+
+    callables = [production.callable for production in xml_parser.parser.productions]
+    for production in xml_parser.parser.productions:
+        if production.callable:
+            production.callable = counted(production.callable)
+
+    print '%-12s %12s %18s' % ('engine', 'reductions', 'symbols/reduction')
+    symbol_class = yacc.YaccSymbol
+    yacc.YaccSymbol = CountedSymbol
+    try:
+        for name, tracking in [('slicing', 1), ('in place', 0)]:
+            counter.update(reductions=0, symbols=0)
+            xml_parser.xml_lexer.input(data)
+            xml_parser.parser.parse(lexer=xml_parser.xml_lexer.lexer, tracking=tracking)
+            print '%-12s %12d %18.2f' % (name, counter['reductions'],
+                                         float(counter['symbols']) / counter['reductions'])
+    finally:
+        yacc.YaccSymbol = symbol_class
+        for production, func in zip(xml_parser.parser.productions, callables):
+            production.callable = func
+
+    number = 5
+    t_parse = _best_time(lambda: xml_parser.parse(data), number) / number
+    print '%.0f reductions/s in place' % (counter['reductions'] / t_parse)
+
+    # Whatever a rule sets on p[0] must reach the rules above it, as with
+    # the slicing engine.  Each rule here numbers p[0] from its symbols.
+    lines = []
+    def numbered(func):
+        def numbered_func(p):
+            func(p)
+            p.slice[0].lineno = max([p.lineno(i) + p.lexpos(i) for i in range(1, len(p))] + [0]) + 1
+            lines.append(p.lineno(0))
+        return numbered_func
+
+    for production in xml_parser.parser.productions:
+        if production.callable:
+            production.callable = numbered(production.callable)
+
+    def push(lexer):
+        xml_parser.parser.push_start(lexer)
+        for tok in iter(lexer.token, None):
+            xml_parser.parser.push(tok)
+        return xml_parser.parser.push_end()
+
+    engine_lines = []
+    xml_parser.parser.use_dense_tables()
+    try:
+        for func in [lambda lexer: xml_parser.parser.parseopt(lexer=lexer),
+                     lambda lexer: xml_parser.parser.parseopt_notrack(lexer=lexer),
+                     lambda lexer: xml_parser.parser.parseopt_dense(lexer=lexer),
+                     push]:
+            del lines[:]
+            xml_parser.xml_lexer.input(data)
+            func(xml_parser.xml_lexer.lexer)
+            engine_lines.append(lines[:])
+    finally:
+        xml_parser.parser.dense = None
+        for production, func in zip(xml_parser.parser.productions, callables):
+            production.callable = func
+
+    assert engine_lines[1:] == engine_lines[:1] * 3, 'p[0] attributes differ between the engines'
+    print 'p[0] line numbers match across engines (%d reductions)' % len(engine_lines[0])
+
+def bench_lextoken():
+    'XmlLexer alone, dictionary tokens with t.lexer vs. slotted tokens without'
+
+    from ply import lex
+
+    data = _generate(500)
+    number = 3
+
+    class DictToken(object):
+        # The former LexToken, with an instance dictionary
+        pass
+
+    def tokenize(xml_lexer):
+        xml_lexer.input(data)
+        return list(iter(xml_lexer.lexer.token, None))
+
+    def token_size(tok):
+        size = sys.getsizeof(tok)
+        if hasattr(tok, '__dict__'):
+            size += sys.getsizeof(tok.__dict__)
+        return size
+
+    print '%-8s %10s %14s %14s' % ('tokens', 'count', 'tokens/s', 'bytes/token')
+    token_class = lex.LexToken
+    try:
+        for name, cls, tokenlexer in [('dict', DictToken, 1), ('slotted', token_class, 0)]:
+            lex.LexToken = cls
+            xml_lexer = parser.XmlLexer()
+            xml_lexer.build()
+            xml_lexer.lexer.lextokenlexer = tokenlexer
+            toks = tokenize(xml_lexer)
+            t_lex = _best_time(lambda: tokenize(xml_lexer), number) / number
+            size = sum([token_size(tok) for tok in toks]) / float(len(toks))
+            print '%-8s %10d %14.0f %14.1f' % (name, len(toks), len(toks) / t_lex, size)
+    finally:
+        lex.LexToken = token_class
+
+def bench_batch():
+    'XmlLexer alone, one token() call per token vs. tokenize_all() into arrays'
+
+    data = _generate(500)
+    number = 3
+    xml_lexer = parser.XmlLexer()
+    xml_lexer.build()
+
+    def one_by_one():
+        xml_lexer.input(data)
+        token = xml_lexer.lexer.token
+        count = 0
+        while token():
+            count += 1
+        return count
+
+    # The lexer's own tokenize_all() leaves the line numbers at 1, the
+    # XmlLexer one fills them from the newline index
+    count = one_by_one()
+    t_token = _best_time(one_by_one, number) / number
+    t_arrays = _best_time(lambda: xml_lexer.lexer.tokenize_all(data), number) / number
+    t_batch = _best_time(lambda: xml_lexer.tokenize_all(data), number) / number
+    print '%d tokens' % count
+    print '%-26s %14.0f tokens/s' % ('token()', count / t_token)
+    print '%-26s %14.0f tokens/s' % ('tokenize_all(), no lines', count / t_arrays)
+    print '%-26s %14.0f tokens/s' % ('tokenize_all()', count / t_batch)
+
+def bench_scanner():
+    'XmlLexer alone, token() vs. the scan() engine, after checking they agree'
+
+    number = 3
+    xml_lexer = parser.XmlLexer()
+    xml_lexer.build()
+
+    def by_token(data):
+        xml_lexer.input(data)
+        return list(iter(xml_lexer.lexer.token, None))
+
+    def by_scan(data):
+        xml_lexer.input(data)
+        return list(xml_lexer.lexer.scan())
+
+    def fields(toks):
+        return [(tok.type, tok.value, tok.lineno, tok.lexpos) for tok in toks]
+
+    documents = [(path, data) for path, data in _samples()]
+    documents.append(('generated', _generate(500)))
+    documents.append(('text', '<doc>%s</doc>' % ('Some text, with no markup at all.\n' * 20000)))
+
+    print '%-24s %8s %14s %14s %8s' % ('document', 'tokens', 'token() (ms)', 'scan() (ms)', 'speedup')
+    for name, data in documents:
+        assert fields(by_token(data)) == fields(by_scan(data)), name
+        count = len(by_token(data))
+        t_by_token = _best_time(lambda: by_token(data), number) / number
+        t_scan = _best_time(lambda: by_scan(data), number) / number
+        print '%-24s %8d %14.2f %14.2f %7.2fx' % (name, count, t_by_token * 1e3, t_scan * 1e3, t_by_token / t_scan)
+
+class _NewlineRuleLexer(parser.XmlLexer):
+    # The former line counting, with a rule for each newline
+    t_tag_ignore = ' \t'
+
+    def t_ANY_newline(self, t):
+        r'\n'
+        self.lexer.lineno += len(t.value)
+
+def bench_newlines():
+    'XmlLexer alone, newline rule vs. newline offset index, on tags split across lines'
+
+    record = '<Product\n  pid="p%d"\n  kind="gizmo"\n>\n  <Name\n  >gizmo</Name\n  >\n</Product\n>\n'
+    data = '<Products>\n%s</Products>\n' % ''.join([record % i for i in range(2000)])
+    number = 3
+
+    def tokenize(xml_lexer):
+        xml_lexer.input(data)
+        return list(iter(xml_lexer.lexer.token, None))
+
+    def positions(xml_lexer):
+        return [xml_lexer.position(tok.lexpos) for tok in tokenize(xml_lexer)]
+
+    rule_lexer = _NewlineRuleLexer()
+    rule_lexer.build()
+    index_lexer = parser.XmlLexer()
+    index_lexer.build()
+
+    lines = data.count('\n')
+    count = len(tokenize(index_lexer))
+    t_rule = _best_time(lambda: tokenize(rule_lexer), number) / number
+    t_index = _best_time(lambda: tokenize(index_lexer), number) / number
+    t_positions = _best_time(lambda: positions(index_lexer), number) / number
+    print '%d tokens, %d lines' % (count, lines)
+    print '%-26s %10.2f ms' % ('newline rule', t_rule * 1e3)
+    print '%-26s %10.2f ms' % ('index', t_index * 1e3)
+    print '%-26s %10.2f ms' % ('index, with all positions', t_positions * 1e3)
+
+def _legacy_escape(text):
+    'Former escaping, one character at a time'
+
+    L=[]
+    for c in text:
+        L.append(parser._xml_escape_table.get(c,c))
+    return "".join(L)
+
+def _legacy_unescape(s):
+    'Former unescaping, one replace pass per entity'
+
+    rules = parser._xml_escape_table.items()
+    rules.reverse()
+
+    for x, y in rules:
+        s = s.replace(y, x)
+
+    return s
+
+def bench_escape():
+    'Escaping and unescaping attribute values, former functions vs. single pass'
+
+    plain = [u'value %d of the attribute' % i for i in range(2000)]
+    special = [u'"%d" < "%d" & \'more\'' % (i, i + 1) for i in range(2000)]
+    number = 5
+
+    def run(func, values):
+        for value in values:
+            func(value)
+
+    for label, values in [('plain', plain), ('special', special)]:
+        escaped = [parser._xml_escape(value) for value in values]
+        print '%s values:' % label
+        for name, func, data in [
+                ('escape, former', _legacy_escape, values),
+                ('escape', parser._xml_escape, values),
+                ('unescape, former', _legacy_unescape, escaped),
+                ('unescape', parser._xml_unescape, escaped)]:
+            t = _best_time(lambda: run(func, data), number) / number
+            print '    %-18s %10.2f ms' % (name, t * 1e3)
+
+def _legacy_str(element):
+    'Former DOM.Element.__str__, concatenating the text of every level'
+
+    attributes_str = ''
+    for attr in element.attributes:
+        attributes_str += ' %s="%s"' % (attr, parser._xml_escape(element.attributes[attr]))
+
+    children_str = ''
+    for child in element.children:
+        if isinstance(child, parser.DOM.Element):
+            children_str += _legacy_str(child)
+        else:
+            children_str += parser._xml_escape_text(child)
+
+    return '<%s%s>%s</%s>'% (element.name, attributes_str, children_str, element.name)
+
+def _deep_tree(depth):
+    'Returns a document tree nested depth elements deep'
+
+    root = element = parser.DOM.Element('node', {'depth': u'0'}, [])
+    for i in xrange(1, depth):
+        child = parser.DOM.Element('node', {'depth': unicode(i)}, ['text'])
+        element.children.append(child)
+        element = child
+    return root
+
+def bench_serialize():
+    'Serializing generated trees, recursive concatenation vs. streaming'
+
+    wide = parser.xml_parse(_generate(4000))
+    deep = _deep_tree(900)
+    deeper = _deep_tree(100000)
+    number = 3
+
+    def write(tree, buffer_size):
+        parser.xml_write(tree, open(os.devnull, 'w'), buffer_size)
+
+    for label, tree in [('wide', wide), ('deep, 900', deep), ('deep, 100000', deeper)]:
+        size = len(str(tree))
+        print '%s tree, %d bytes:' % (label, size)
+        for name, func in [
+                ('concatenation', lambda: _legacy_str(tree)),
+                ('str()', lambda: str(tree)),
+                ('chunks of 64k', lambda: list(parser.xml_serialize(tree, 64 * 1024))),
+                ('write, unbuffered', lambda: write(tree, 0)),
+                ('write, 64k buffer', lambda: write(tree, 64 * 1024))]:
+            try:
+                t = _best_time(func, number) / number
+            except RuntimeError:
+                print '    %-20s %10s' % (name, 'recursion limit')
+                continue
+            print '    %-20s %10.2f ms %8.1f MB/s' % (name, t * 1e3, size / t / 1e6)
+
+# Most memory a deep document may take per level of nesting, in kB, and most
+# growth of the memory when the depth doubles
+_DEEP_KB_PER_LEVEL = 4
+_DEEP_DOUBLING_RATIO = 2.5
+
+def _deep_round_trip(depth):
+    '''Parses and round-trips a document nested depth levels deep
+
+    Prints the time and max RSS of each stage and returns the growth of the
+    max RSS, in kB.  Run in a process of its own, since the max RSS only
+    grows.
+    '''
+
+    data = '<node level="deep">' * depth + 'x &amp; y' + '</node>' * depth
+
+    def check(label, func, *args):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print '    %-20s %10.2f ms %10d kB max RSS' % (label, elapsed * 1e3, rss)
+        return result
+
+    def serialize(root):
+        out = StringIO()
+        parser.xml_write(root, out)
+        return out.getvalue()
+
+    def events(data):
+        count = 0
+        for event, element in parser.iterparse(StringIO(data)):
+            count += 1
+        return count
+
+    def walk(root):
+        return len(list(parser.walk(root)))
+
+    # Any recursion per level fails well before the document ends
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(200)
+    try:
+        print '%d levels, %d bytes' % (depth, len(data))
+        parser.XmlParser()
+        start = check('start', resource.getrusage, resource.RUSAGE_SELF).ru_maxrss
+        root = check('parse', parser.xml_parse, data)
+        assert check('serialize', serialize, root) == data
+        assert check('walk', walk, root) == 2 * depth
+        copy = check('copy', parser.copy_tree, root)
+        assert check('compare', parser.equal_trees, root, copy)
+        copy.children[0] = parser.DOM.Element('other')
+        assert not check('compare, different', parser.equal_trees, root, copy)
+        del root, copy
+
+        store = check('parse, store', parser.XmlParser(store=True).parse, data)
+        assert check('serialize, store', serialize, store) == data
+        del store
+
+        assert check('iterparse', events, data) == 2 * depth
+    finally:
+        sys.setrecursionlimit(limit)
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start
+
+def bench_deep():
+    'Parsing and round-tripping documents nested 100000 levels deep, without recursion'
+
+    growth = {}
+    for depth in (50000, 100000):
+        script = 'import benchmark\nprint benchmark._deep_round_trip(%d)\n' % depth
+        process = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE)
+        lines = process.communicate()[0].splitlines()
+        assert process.returncode == 0, 'the round trip of %d levels failed' % depth
+        print '\n'.join(lines[:-1])
+        growth[depth] = int(lines[-1])
+        print '    %.2f kB per level' % (float(growth[depth]) / depth)
+        assert growth[depth] <= _DEEP_KB_PER_LEVEL * depth, 'memory is not bounded per level'
+
+    ratio = float(growth[100000]) / growth[50000]
+    print 'memory growth, 100000 vs. 50000 levels: %.2fx' % ratio
+    assert ratio <= _DEEP_DOUBLING_RATIO, 'memory does not grow linearly with the depth'
+
+def bench_parallel():
+    'parse_many() throughput across worker processes'
+
+    import multiprocessing
+
+    documents = [_generate(20 + i % 20) for i in range(400)]
+    cpus = multiprocessing.cpu_count()
+    counts = sorted(set([1, 2, 4, cpus]))
+
+    print '%d documents, %d processors' % (len(documents), cpus)
+    print '%-8s %-12s %10s %10s' % ('workers', 'results', 'docs/s', 'scaling')
+    for label, options in [('trees', {}), ('xml text', {'serialized': True}),
+                           ('unordered', {'ordered': False})]:
+        base = None
+        for workers in counts:
+            t = _best_time(lambda: list(parser.parse_many(blobs=documents, workers=workers, **options)), 1)
+            rate = len(documents) / t
+            if base is None:
+                base = rate
+            print '%-8d %-12s %10.1f %9.2fx' % (workers, label, rate, rate / base)
+
+def bench_yacccache():
+    'Cold start of yacc from parsetab.py, pickled and binary tables'
+
+    tmpdir = tempfile.mkdtemp()
+    _synthetic_grammar(os.path.join(tmpdir, 'synthetic.py'), 150)
+
+    formats = [
+        ('parsetab.py', 'pickle_protocol = 2', "tabmodule='tab_%(name)s'"),
+        ('pickle 0', 'pickle_protocol = 0', "picklefile='%(dir)s/%(name)s.pickle0'"),
+        ('pickle 2', 'pickle_protocol = 2', "picklefile='%(dir)s/%(name)s.pickle2'"),
+        ('binary', 'pickle_protocol = 2', "binfile='%(dir)s/%(name)s.bin'"),
+    ]
+
+    try:
+        for name, method in [('parser', 'SLR'), ('synthetic', 'LALR')]:
+            print '%s grammar (%s):' % (name, method)
+            for label, protocol, option in formats:
+                option = option % {'dir': tmpdir, 'name': name}
+                setup = ('import sys\n'
+                         'sys.path[:0] = [%r, %r]\n'
+                         'from ply import yacc\n'
+                         'yacc.%s\n'
+                         'import %s\n') % (os.getcwd(), tmpdir, protocol, name)
+                statement = ('yacc.yacc(module=%s, method=%r, debug=0, outputdir=%r, '
+                             'errorlog=yacc.NullLogger(), %s)') % (name, method, tmpdir, option)
+
+                # The first run generates the tables, the best run loads them
+                t_load = _cold_time(statement, setup)
+                print '    %-12s %10.2f ms' % (label, t_load * 1e3)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+_BENCHMARKS = [
+    ('reuse', bench_reuse),
+    ('trace', bench_trace),
+    ('siblings', bench_siblings),
+    ('events', bench_events),
+    ('iterparse', bench_iterparse),
+    ('memory', bench_memory),
+    ('store', bench_store),
+    ('spans', bench_spans),
+    ('mmap', bench_mmap),
+    ('lexcache', bench_lexcache),
+    ('yacccache', bench_yacccache),
+    ('dense', bench_dense),
+    ('specialized', bench_specialized),
+    ('reduce', bench_reduce),
+    ('lextoken', bench_lextoken),
+    ('batch', bench_batch),
+    ('scanner', bench_scanner),
+    ('newlines', bench_newlines),
+    ('escape', bench_escape),
+    ('serialize', bench_serialize),
+    ('deep', bench_deep),
+    ('parallel', bench_parallel),
+]
+
+
+################################
+# MAIN
+
+def main():
+    names = sys.argv[1:] or [name for name, func in _BENCHMARKS]
+    benchmarks = dict(_BENCHMARKS)
+
+    for name in names:
+        print '== %s: %s' % (name, benchmarks[name].__doc__)
+        benchmarks[name]()
+        print
+
+if __name__ == '__main__':
+    main()
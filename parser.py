@@ -1,7 +1,14 @@
 #!/usr/bin/env python
 
+import os
+import re
+import errno
 import sys
-from UserString import UserString
+import stat
+import mmap
+import itertools
+from array import array
+from bisect import bisect_left
 
 from ply import lex, yacc
 
@@ -21,6 +28,10 @@ class XmlLexer:
     #   tag:        The document tag context
     #   attrvalue1: Single-quoted tag attribute value
     #   attrvalue2: Double-quoted tag attribute value
+    #
+    # Lines are not counted as the input is scanned, so the lineno of the
+    # tokens is not maintained and stays at 1.  position() gives the line and
+    # column of a token from its lexpos, through an index of the newlines.
 
     states = (
         ('tag', 'exclusive'),
@@ -63,8 +74,9 @@ class XmlLexer:
     # ANY
 
     def t_ANY_error(self, t):
-        raise SyntaxError("Illegal character '%s'" % t.value[0])
-        t.lexer.skip(1)
+        line, column = self.position(self.offset + t.lexpos)
+        raise SyntaxError("Illegal character '%s' at line %d, column %d" % (t.value[0], line, column))
+        self.lexer.skip(1)
         pass
 
 
@@ -74,35 +86,41 @@ class XmlLexer:
 
     def t_CLOSETAGOPEN(self, t):
         r'</'
-        t.lexer.push_state('tag')
+        self.lexer.push_state('tag')
         return t
 
     def t_OPENTAGOPEN(self, t):
         r'<'
-        t.lexer.push_state('tag')
+        self.lexer.push_state('tag')
         return t
 
     def t_PCDATA(self, t):
         '[^<]+'
+        if t.value is not None and t.value.isspace():
+            space = self.names.get(t.value)
+            if space is None:
+                space = self.names[t.value] = unicode(t.value)
+            t.value = space
         return t
 
 
     # tag: name
 
-    t_tag_ignore  = ' \t'
+    t_tag_ignore  = ' \t\n'
 
     def t_tag_TAGATTRNAME(self, t):
+        t.value = self.names.setdefault(t.value, t.value)
         return t
     t_tag_TAGATTRNAME.__doc__ = re_identifier
 
     def t_tag_TAGCLOSE(self, t):
         r'>'
-        t.lexer.pop_state()
+        self.lexer.pop_state()
         return t
 
     def t_tag_LONETAGCLOSE(self, t):
         r'/>'
-        t.lexer.pop_state()
+        self.lexer.pop_state()
         return t
 
 
@@ -112,12 +130,12 @@ class XmlLexer:
 
     def t_tag_ATTRVALUE1OPEN(self, t):
         r'\''
-        t.lexer.push_state('attrvalue1')
+        self.lexer.push_state('attrvalue1')
         return t
 
     def t_tag_ATTRVALUE2OPEN(self, t):
         r'"'
-        t.lexer.push_state('attrvalue2')
+        self.lexer.push_state('attrvalue2')
         return t
 
 
@@ -125,12 +143,13 @@ class XmlLexer:
 
     def t_attrvalue1_ATTRVALUE1STRING(self, t):
         r'[^\']+'
-        t.value = unicode(t.value)
+        if t.value is not None:
+            t.value = _xml_decode(t.value)
         return t
 
     def t_attrvalue1_ATTRVALUE1CLOSE(self, t):
         r'\''
-        t.lexer.pop_state()
+        self.lexer.pop_state()
         return t
 
     t_attrvalue1_ignore  = ''
@@ -140,12 +159,13 @@ class XmlLexer:
 
     def t_attrvalue2_ATTRVALUE2STRING(self, t):
         r'[^"]+'
-        t.value = unicode(t.value)
+        if t.value is not None:
+            t.value = _xml_decode(t.value)
         return t
 
     def t_attrvalue2_ATTRVALUE2CLOSE(self, t):
         r'"'
-        t.lexer.pop_state()
+        self.lexer.pop_state()
         return t
 
     t_attrvalue2_ignore  = ''
@@ -155,25 +175,180 @@ class XmlLexer:
 
     literals = '$%^'
 
-    def t_ANY_newline(self, t):
-        r'\n'
-        t.lexer.lineno += len(t.value)
 
-
-    # Build the lexer
+    # Build the lexer.  The rules reach the lexer through self.lexer, so it
+    # is not set on every token.  p_error() reaches this object through the
+    # lexer.
     def build(self, **kwargs):
         self.lexer = lex.lex(object=self, **kwargs)
+        self.lexer.lexmodule = self
+        self.lexer.lextokenlexer = 0
+        self.lexer.lexbatchactions = self.batch_actions
+
+    # Leave the text and attribute values in the input.  Their tokens then
+    # carry a None value and the span of the input between lexpos and
+    # lexend.
+    def use_spans(self):
+        self.lexer.lexspans = dict.fromkeys(['PCDATA', 'ATTRVALUE1STRING', 'ATTRVALUE2STRING'])
+
+    # Reset the lexer and feed it a new document
+    def input(self, data):
+        self.lexer.begin('INITIAL')
+        del self.lexer.lexstatestack[:]
+        self.lexer.lineno = 1
+        self.lexer.input(data)
+        self.offset = 0
+
+        # Names and whitespace-only text are shared within a document
+        self.names = {}
+
+        # Offsets of the newlines of the input held by the lexer, indexed
+        # when a position is first asked for, or as the input is fed.  The
+        # newlines of the input already dropped by feed() are only counted,
+        # and the offset of the last of them kept.
+        self.newlines = None
+        self.newline_count = 0
+        self.last_newline = -1
+        self.fed = len(data)
+
+    # Return the newline offset index of the input held by the lexer
+    def newline_index(self):
+        if self.newlines is None:
+            self.newlines = _newline_offsets(self.lexer.lexdata, self.offset)
+        return self.newlines
+
+    # Return the line and column numbers, counted from 1, of an offset in
+    # the input.  Tokens do not track lines: pass them their lexpos.
+    def position(self, lexpos):
+        newlines = self.newline_index()
+        line = bisect_left(newlines, lexpos)
+        if line:
+            return self.newline_count + line + 1, lexpos - newlines[line - 1]
+        return self.newline_count + 1, lexpos - self.last_newline
+
+    # What the rules do, apart from computing values, for tokenize_all()
+    batch_actions = {
+        'CLOSETAGOPEN': ('push', 'tag'),
+        'OPENTAGOPEN': ('push', 'tag'),
+        'PCDATA': (),
+        'TAGATTRNAME': (),
+        'TAGCLOSE': ('pop',),
+        'LONETAGCLOSE': ('pop',),
+        'ATTRVALUE1OPEN': ('push', 'attrvalue1'),
+        'ATTRVALUE2OPEN': ('push', 'attrvalue2'),
+        'ATTRVALUE1STRING': (),
+        'ATTRVALUE2STRING': (),
+        'ATTRVALUE1CLOSE': ('pop',),
+        'ATTRVALUE2CLOSE': ('pop',),
+    }
+
+    # Scan a whole document into parallel arrays of token type ids, start
+    # and end positions and line numbers.  The type ids index the list
+    # returned by self.lexer.typenames().  The state changes of the rules
+    # are made by the batch loop itself, without calling them.
+    def tokenize_all(self, data):
+        self.input(data)
+        types, starts, ends, lines = self.lexer.tokenize_all(data)
+
+        # One pass over the newlines: the tokens starting after the newline
+        # of line n and up to the next newline are on line n + 1.  Both
+        # lists are sorted, so each run of tokens is found by bisection and
+        # filled at once.
+        count = len(starts)
+        first = 0
+        line = 1
+        for offset in self.newline_index():
+            last = bisect_left(starts, offset + 1, first)
+            if last > first:
+                lines[first:last] = array('l', [line]) * (last - first)
+                first = last
+            line += 1
+        if count > first:
+            lines[first:] = array('l', [line]) * (count - first)
+
+        return types, starts, ends, lines
+
+    # Append a chunk to the input and return the tokens that are complete.
+    # A token that reaches the end of the chunk may go on in the next one, so
+    # it is scanned again once more input is available.  Only the input past
+    # the last complete token is kept.
+    def feed(self, data, final=False):
+        lexer = self.lexer
+
+        # Only index the newlines of the input that is kept
+        newlines = self.newline_index()
+        consumed = bisect_left(newlines, self.offset + lexer.lexpos)
+        if consumed:
+            self.newline_count += consumed
+            self.last_newline = newlines[consumed - 1]
+            del newlines[:consumed]
+        newlines.extend(_newline_offsets(data, self.fed))
+        self.fed += len(data)
+
+        self.offset += lexer.lexpos
+        buf = lexer.lexdata[lexer.lexpos:] + data
+        lexer.input(buf)
+
+        toks = []
+        while 1:
+            # Where to roll back to
+            lexpos = lexer.lexpos
+            lexstate = lexer.lexstate
+            lexstatestack = lexer.lexstatestack[:]
+
+            try:
+                tok = lexer.token()
+                complete = final or lexer.lexpos < lexer.lexlen
+            except SyntaxError:
+                # Not an error yet, if the rest may still be a valid token
+                if final or lexer.lexlen - lexer.lexpos >= _LONGEST_LITERAL:
+                    raise
+                complete = False
+            except ParserError:
+                # A value cut in the middle of a UTF-8 sequence
+                if final or lexer.lexpos < lexer.lexlen:
+                    raise
+                complete = False
+
+            if not complete:
+                lexer.lexpos = lexpos
+                lexer.begin(lexstate)
+                lexer.lexstatestack[:] = lexstatestack
+                break
+
+            if not tok: break
+            tok.lexpos += self.offset
+            toks.append(tok)
+
+        return toks
+
+    # Get the next token, printing it out
+    def traced_token(self):
+        tok = self.lexer.token()
+        if tok:
+            line, column = self.position(self.offset + tok.lexpos)
+            _debug_print_('LEXER', '[%-12s] %s %r at line %d, column %d'
+                          % (self.lexer.lexstate, tok.type, tok.value, line, column))
+        return tok
 
     # Test it output
     def test(self, data):
-        self.lexer.input(data)
+        self.input(data)
 
         while 1:
-            tok = self.lexer.token()
+            tok = self.traced_token()
             if not tok: break
-            _debug_print_('LEXER', '[%-12s] %s' % (self.lexer.lexstate, tok))
 
 
+# The longest fixed token, '</' or '/>'
+_LONGEST_LITERAL = 2
+
+_NEWLINE = re.compile('\n')
+
+# The offsets of the newlines of data, plus start
+def _newline_offsets(data, start=0):
+    return array('l', [m.start() + start for m in _NEWLINE.finditer(data)])
+
 # Customization
 class SyntaxError(Exception):
     pass
@@ -182,7 +357,7 @@ class SyntaxError(Exception):
 ################################
 # PARSER
 
-tag_stack = []
+tokens = XmlLexer.tokens
 
 # Grammer
 
@@ -190,26 +365,23 @@ def p_root_element(p):
     '''root : element
             | element PCDATA
     '''
-    _parser_trace(p)
-
     p[0] = p[1]
 
 def p_root_pcdata_element(p):
     '''root : PCDATA element
             | PCDATA element PCDATA
     '''
-    _parser_trace(p)
-
     p[0] = p[2]
 
 def p_element(p):
     '''element : opentag children closetag
                | lonetag
     '''
-    _parser_trace(p)
-
     if len(p) == 4:
-        p[1].children = p[2]
+        if p[3] != p[1].name:
+            raise ParserError('Close tag name ("%s") does not match the corresponding open tag ("%s").' % (p[3], p[1].name))
+        if p[2]:
+            p[1].children = p[2]
 
     p[0] = p[1]
 
@@ -217,84 +389,60 @@ def p_element(p):
 def p_opentag(p):
     '''opentag : OPENTAGOPEN TAGATTRNAME attributes TAGCLOSE
     '''
-    _parser_trace(p)
-
-    tag_stack.append(p[2])
     p[0] = DOM.Element(p[2], p[3])
 
 def p_closetag(p):
     '''closetag : CLOSETAGOPEN TAGATTRNAME TAGCLOSE
     '''
-    _parser_trace(p)
-
-    n = tag_stack.pop()
-    if p[2] != n:
-        raise ParserError('Close tag name ("%s") does not match the corresponding open tag ("%s").' % (p[2], n))
+    p[0] = p[2]
 
 def p_lonetag(p):
     '''lonetag : OPENTAGOPEN TAGATTRNAME attributes LONETAGCLOSE
     '''
-    _parser_trace(p)
-
     p[0] = DOM.Element(p[2], p[3])
 
 # attr
 def p_attributes(p):
-    '''attributes : attribute attributes
+    '''attributes : attributes attribute
                   | empty
     '''
-    _parser_trace(p)
-
     if len(p) == 3:
-        if p[2]:
-            p[1].update(p[2])
-            p[0] = p[1]
-        else:
-            p[0] = p[1]
+        attributes = p[1] or {}
+        name, value = p[2]
+        attributes[name] = value
+        p[0] = attributes
     else:
-        p[0] = {}
+        p[0] = _NO_ATTRIBUTES
 
 def p_attribute(p):
     '''attribute : TAGATTRNAME ATTRASSIGN attrvalue
     '''
-    _parser_trace(p)
-
-    p[0] = {p[1]: p[3]}
+    p[0] = (p[1], p[3])
 
 def p_attrvalue(p):
     '''attrvalue : ATTRVALUE1OPEN ATTRVALUE1STRING ATTRVALUE1CLOSE
                  | ATTRVALUE2OPEN ATTRVALUE2STRING ATTRVALUE2CLOSE
     '''
-    _parser_trace(p)
-
     p[0] = _xml_unescape(p[2])
 
 # child
 def p_children(p):
-    '''children : child children
+    '''children : children child
                 | empty
     '''
-    _parser_trace(p)
-
-    if len(p) > 2:
-        if p[2]:
-            p[0] = [p[1]] + p[2]
-        else:
-            p[0] = [p[1]]
+    if len(p) == 3:
+        p[1].append(p[2])
+        p[0] = p[1]
     else:
         p[0] = []
 
 def p_child_element(p):
     '''child : element'''
-    _parser_trace(p)
-
     p[0] = p[1]
 
 def p_child_pcdata(p):
     '''child : PCDATA'''
-    _parser_trace(p)
-
-    p[0] = DOM.Pcdata(p[1])
+    p[0] = _xml_text(p[1])
 
 # empty
 def p_empty(p):
@@ -306,52 +454,408 @@ class ParserError(Exception):
     pass
 
 def p_error(p):
+    if p is not None and isinstance(p.lexer.lexmodule, XmlLexer):
+        line, column = p.lexer.lexmodule.position(p.lexpos)
+        raise ParserError("Parse error: %s %r at line %d, column %d"
+                          % (p.type, p.value, line, column))
     raise ParserError("Parse error: %s" % (p,))
     pass
 
-# Customization
-def _parser_trace(x):
-    _debug_print_('PARSER', '[%-16s] %s' % (sys._getframe(1).f_code.co_name, x))
+# Events
+class ContentHandler:
+    '''Receives the content of a document as it is parsed
+
+    Subclass it and give an instance to XmlParser to have the document
+    reported as events, instead of being built as a document tree.
+    '''
+
+    def start_element(self, name, attributes):
+        pass
+
+    def end_element(self, name):
+        pass
+
+    def characters(self, data):
+        pass
+
+class _EventRules:
+    '''Grammar rules reporting to a content handler
+
+    Each method takes the place of the p_* function of the same name, less
+    the prefix, in an event parser.  No part of the document tree is built:
+    elements are only passed around by name.
+    '''
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def root_element(self, p):
+        pass
+
+    def root_pcdata_element(self, p):
+        pass
+
+    def element(self, p):
+        if len(p) == 4:
+            if p[3] != p[1]:
+                raise ParserError('Close tag name ("%s") does not match the corresponding open tag ("%s").' % (p[3], p[1]))
+            self.handler.end_element(p[3])
 
-def _yacc_production__str(p):
-    #return "YaccProduction(%s, %s)" % (str(p.slice), str(p.stack))
-    return "YaccP%s" % (str([i.value for i in p.slice]))
-yacc.YaccProduction.__str__ = _yacc_production__str
+    def opentag(self, p):
+        self.handler.start_element(p[2], p[3])
+        p[0] = p[2]
+
+    def closetag(self, p):
+        p[0] = p[2]
+
+    def lonetag(self, p):
+        self.handler.start_element(p[2], p[3])
+        self.handler.end_element(p[2])
+
+    attributes = staticmethod(p_attributes)
+    attribute = staticmethod(p_attribute)
+    attrvalue = staticmethod(p_attrvalue)
+
+    def children(self, p):
+        pass
+
+    def child_element(self, p):
+        pass
+
+    def child_pcdata(self, p):
+        self.handler.characters(_xml_text(p[1]))
+
+    def empty(self, p):
+        pass
+
+class _StoreRules:
+    '''Grammar rules building a DocumentStore
+
+    Each method takes the place of the p_* function of the same name, less
+    the prefix, in a store parser.  Attribute values and text are passed
+    around as the (start, end) offsets of their tokens.
+    '''
+
+    def start(self, data):
+        self.store = DocumentStore(data)
+
+    def root_element(self, p):
+        p[0] = self.store.root()
+
+    def root_pcdata_element(self, p):
+        p[0] = self.store.root()
+
+    def element(self, p):
+        if len(p) == 4:
+            name, end = p[3]
+            if name != p[1]:
+                raise ParserError('Close tag name ("%s") does not match the corresponding open tag ("%s").' % (name, p[1]))
+            self.store.end_element(end)
+
+    def opentag(self, p):
+        self.store.start_element(p[2], p[3], p.lexpos(1))
+        p[0] = p[2]
+
+    def closetag(self, p):
+        p[0] = (p[2], p.lexpos(3) + 1)
+
+    def lonetag(self, p):
+        self.store.start_element(p[2], p[3], p.lexpos(1))
+        self.store.end_element(p.lexpos(4) + 2)
+
+    def attributes(self, p):
+        if len(p) == 3:
+            attributes = p[1] or []
+            attributes.append(p[2])
+            p[0] = attributes
+        else:
+            p[0] = _NO_CHILDREN
+
+    def attribute(self, p):
+        p[0] = (p[1],) + p[3]
+
+    def attrvalue(self, p):
+        p[0] = (p.lexpos(2), p.lexpos(3))
+
+    def children(self, p):
+        pass
+
+    def child_element(self, p):
+        pass
+
+    def child_pcdata(self, p):
+        self.store.add_text(p.lexpos(1), p.lexend(1))
+
+    def empty(self, p):
+        pass
+
+# Tracing
+def _traced(name, func):
+    'Wraps a grammar rule function so that its reductions are printed'
+
+    def traced_func(p):
+        _debug_print_('PARSER', '[%-16s] YaccP%s' % (name, [i.value for i in p.slice]))
+        func(p)
+
+    return traced_func
 
 
 ################################
 # DOM
 
+# Elements without attributes or without children share these, read-only,
+# empty containers
+class _ReadOnlyDict(dict):
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('Read-only dictionary')
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    # Unpickled as the shared instance
+    def __reduce__(self):
+        return '_NO_ATTRIBUTES'
+
+_NO_ATTRIBUTES = _ReadOnlyDict()
+_NO_CHILDREN = ()
+
 class DOM:
-    class Element:
+    class Element(object):
         # Document object model
         #
-        # Parser returns the root element of the XML document
+        # Parser returns the root element of the XML document.  The children
+        # of an element are elements and strings (the text).
+        #
+        # Elements without attributes or without children share read-only
+        # empty containers, so their attributes and children cannot be
+        # changed in place.  Use set() and append(), which give the element
+        # a container of its own on first write.
+
+        __slots__ = ('name', 'attributes', 'children')
 
-        def __init__(self, name, attributes={}, children=[]):
+        def __init__(self, name, attributes=_NO_ATTRIBUTES, children=_NO_CHILDREN):
             self.name = name
             self.attributes = attributes
             self.children = children
 
         def __str__(self):
-            attributes_str = ''
-            for attr in self.attributes:
-                attributes_str += ' %s="%s"' % (attr, _xml_escape(self.attributes[attr]))
-
-            children_str = ''
-            for child in self.children:
-                if isinstance(child, self.__class__):
-                    children_str += str(child)
-                else:
-                    children_str += child
-
-            return '<%s%s>%s</%s>'% (self.name, attributes_str, children_str, self.name)
+            return ''.join(_serialize(self))
 
         def __repr__(self):
             return str(self)
 
-    class Pcdata(UserString):
-        pass
+        def __deepcopy__(self, memo):
+            return copy_tree(self)
+
+        # The class is not reachable by its name from the module
+        def __reduce__(self):
+            return _element, (self.name, self.attributes, self.children)
+
+        def clear(self):
+            'Detaches all the children of the element'
+            self.children = []
+
+        def set(self, name, value):
+            'Sets the value of an attribute'
+            if self.attributes is _NO_ATTRIBUTES:
+                self.attributes = {}
+            self.attributes[name] = value
+
+        def append(self, child):
+            'Adds a child element or text at the end of the children'
+            if self.children is _NO_CHILDREN:
+                self.children = []
+            self.children.append(child)
+
+
+def _element(name, attributes, children):
+    return DOM.Element(name, attributes, children)
+
+
+################################
+# STORE
+
+class DocumentStore(object):
+    '''Document stored in parallel arrays
+
+    This is an alternative to the tree of DOM.Element objects.  Nodes are
+    numbered in document order and each of their fields is kept in an array.
+    Text and attribute values are kept as offsets into the input data, and
+    names as indexes into a table of names.  Element views are only created
+    on demand, by root(), element() and the views themselves.
+    '''
+
+    def __init__(self, data):
+        self.data = data                    # Input data, a string or a buffer
+        self.names = []                     # Name table
+        self.name_ids = {}                  # Name to index in the name table
+
+        # Nodes
+        self.node_name = array('i')         # Name index, or -1 for text
+        self.node_parent = array('i')       # Parent node, or -1
+        self.node_first_child = array('i')  # First child node, or -1
+        self.node_next_sibling = array('i') # Next sibling node, or -1
+        self.node_start = array('l')        # Offset of the element or text
+        self.node_end = array('l')          # Offset past the element or text
+        self.node_attributes = array('i')   # First attribute of the node
+
+        # Attributes
+        self.attr_name = array('i')         # Name index
+        self.attr_start = array('l')        # Offset of the value
+        self.attr_end = array('l')          # Offset past the value
+
+        # Open elements and their last children, while building
+        self._path = []
+        self._last_child = []
+
+    def __len__(self):
+        return len(self.node_name)
+
+    # Building
+
+    def _add_node(self, name_id, start, end):
+        node = len(self.node_name)
+        self.node_name.append(name_id)
+        self.node_first_child.append(-1)
+        self.node_next_sibling.append(-1)
+        self.node_start.append(start)
+        self.node_end.append(end)
+        self.node_attributes.append(len(self.attr_name))
+
+        if self._path:
+            parent = self._path[-1]
+            last_child = self._last_child[-1]
+            if last_child < 0:
+                self.node_first_child[parent] = node
+            else:
+                self.node_next_sibling[last_child] = node
+            self._last_child[-1] = node
+        else:
+            parent = -1
+        self.node_parent.append(parent)
+
+        return node
+
+    def _name_id(self, name):
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def start_element(self, name, attributes, start):
+        node = self._add_node(self._name_id(name), start, -1)
+        for attr_name, attr_start, attr_end in attributes:
+            self.attr_name.append(self._name_id(attr_name))
+            self.attr_start.append(attr_start)
+            self.attr_end.append(attr_end)
+
+        self._path.append(node)
+        self._last_child.append(-1)
+
+    def end_element(self, end):
+        node = self._path.pop()
+        self._last_child.pop()
+        self.node_end[node] = end
+
+    def add_text(self, start, end):
+        self._add_node(-1, start, end)
+
+    # Access
+
+    def root(self):
+        return self.element(0)
+
+    def element(self, node):
+        return StoreElement(self, node)
+
+    def text(self, node):
+        return self.data[self.node_start[node]:self.node_end[node]]
+
+    def elements(self, name):
+        'Yields the views of all the elements with the given name, in order'
+
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            return
+
+        node_name = self.node_name
+        for node in xrange(len(node_name)):
+            if node_name[node] == name_id:
+                yield StoreElement(self, node)
+
+
+class StoreElement(object):
+    '''View of an element of a DocumentStore
+
+    Has the same name, attributes and children as a DOM.Element, computed
+    on each access.
+    '''
+
+    __slots__ = ('store', 'node')
+
+    def __init__(self, store, node):
+        self.store = store
+        self.node = node
+
+    def __eq__(self, other):
+        return isinstance(other, StoreElement) and self.store is other.store and self.node == other.node
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.store), self.node))
+
+    @property
+    def name(self):
+        return self.store.names[self.store.node_name[self.node]]
+
+    @property
+    def attributes(self):
+        store = self.store
+        first = store.node_attributes[self.node]
+        if self.node + 1 < len(store.node_attributes):
+            last = store.node_attributes[self.node + 1]
+        else:
+            last = len(store.attr_name)
+
+        attributes = {}
+        for attr in xrange(first, last):
+            value = store.data[store.attr_start[attr]:store.attr_end[attr]]
+            attributes[store.names[store.attr_name[attr]]] = _xml_text(value)
+        return attributes
+
+    @property
+    def children(self):
+        store = self.store
+        children = []
+        node = store.node_first_child[self.node]
+        while node >= 0:
+            if store.node_name[node] < 0:
+                children.append(_xml_text(store.text(node)))
+            else:
+                children.append(StoreElement(store, node))
+            node = store.node_next_sibling[node]
+        return children
+
+    @property
+    def parent(self):
+        parent = self.store.node_parent[self.node]
+        if parent >= 0:
+            return StoreElement(self.store, parent)
+
+    def to_element(self):
+        'Returns a DOM.Element copy of the element and its descendants'
+        return copy_tree(self)
+
+    def __str__(self):
+        return ''.join(_serialize(self))
+
+    def __repr__(self):
+        return str(self)
 
 
 ################################
@@ -365,82 +869,602 @@ _xml_escape_table = {
     "<": "&lt;",
     }
 
+_xml_entities = {
+    'amp': '&',
+    'quot': '"',
+    'apos': "'",
+    'gt': '>',
+    'lt': '<',
+    }
+
+# Text only needs the characters that can open or close markup escaped,
+# attribute values also need their quotes.  Unicode strings are translated in
+# a single pass and encoded to ASCII, with character references for the
+# other characters, so the serialized document is always a byte string.
+# Byte strings cannot be translated to several characters, so they go
+# through one replace per special character, the ampersand first.
+_XML_ESCAPE = re.compile('[&"\'<>]')
+_XML_ESCAPE_TEXT = re.compile('[&<>]')
+
+_xml_translate = dict([(ord(c), unicode(e)) for c, e in _xml_escape_table.items()])
+_xml_translate_text = dict([(ord(c), unicode(_xml_escape_table[c])) for c in '&<>'])
+
 def _xml_escape(text):
-    L=[]
-    for c in text:
-        L.append(_xml_escape_table.get(c,c))
-    return "".join(L)
+    'Escapes the text of an attribute value'
+
+    if isinstance(text, unicode):
+        if _XML_ESCAPE.search(text) is not None:
+            text = text.translate(_xml_translate)
+        return text.encode('ascii', 'xmlcharrefreplace')
+    if _XML_ESCAPE.search(text) is None:
+        return text
+    return (text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+                .replace('"', '&quot;').replace("'", '&apos;'))
+
+def _xml_escape_text(text):
+    'Escapes the text of an element'
+
+    if isinstance(text, unicode):
+        if _XML_ESCAPE_TEXT.search(text) is not None:
+            text = text.translate(_xml_translate_text)
+        return text.encode('ascii', 'xmlcharrefreplace')
+    if _XML_ESCAPE_TEXT.search(text) is None:
+        return text
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+# Text and attribute values are unicode, decoded from UTF-8, the default
+# encoding of XML documents.  Unknown entities and references to characters
+# outside of the unicode range are left as they are.
+_XML_REFERENCE = re.compile('&(#[0-9]+|#[xX][0-9a-fA-F]+|[A-Za-z]+);')
+
+def _xml_reference(match):
+    reference = match.group(1)
+    if reference[0] != '#':
+        return _xml_entities.get(reference, match.group())
+
+    if reference[1] in 'xX':
+        code = int(reference[2:], 16)
+    else:
+        code = int(reference[1:])
+    try:
+        return unichr(code)
+    except (ValueError, OverflowError):
+        return match.group()
+
+def _xml_decode(s):
+    'Decodes text or an attribute value of the document'
+
+    if isinstance(s, unicode):
+        return s
+    try:
+        return s.decode('utf-8')
+    except UnicodeDecodeError, e:
+        raise ParserError('Text is not valid UTF-8: %s' % e)
+
+def _xml_text(s):
+    'Decodes text or an attribute value and replaces its references'
+
+    return _xml_unescape(_xml_decode(s))
 
 def _xml_unescape(s):
-    rules = _xml_escape_table.items()
-    rules.reverse()
+    'Replaces the entity and character references in the text'
 
-    for x, y in rules:
-        s = s.replace(y, x)
+    if '&' not in s:
+        return s
+    if '&#' in s:
+        return _XML_REFERENCE.sub(_xml_reference, s)
 
-    return s
+    # Without character references, replacing the predefined entities one
+    # after the other, the ampersand last, gives the same result as the
+    # single pass and is faster
+    return (s.replace('&lt;', '<').replace('&gt;', '>').replace('&quot;', '"')
+             .replace('&apos;', "'").replace('&amp;', '&'))
+
+
+################################
+# SERIALIZE
+
+def _start_tag(element):
+    attributes = element.attributes
+    if not attributes:
+        return '<%s>' % element.name
+    return '<%s%s>' % (element.name, ''.join([' %s="%s"' % (attr, _xml_escape(value))
+                                              for attr, value in attributes.items()]))
+
+def _serialize(element):
+    '''Yields the pieces of the XML text of an element
+
+    The tree is walked with a stack of the open elements and of the
+    iterators over their children, so the depth of the document is not
+    limited by the recursion limit.  Elements are DOM.Element or
+    StoreElement objects; the children which are strings are text.
+    '''
+
+    stack = [(None, iter((element,)))]
+    push = stack.append
+    pop = stack.pop
+
+    while stack:
+        name, children = stack[-1]
+        for child in children:
+            if isinstance(child, basestring):
+                yield _xml_escape_text(child)
+            else:
+                yield _start_tag(child)
+                push((child.name, iter(child.children)))
+                break
+        else:
+            pop()
+            if name is not None:
+                yield '</%s>' % name
+
+def _buffered(pieces, buffer_size):
+    'Joins the pieces into chunks of at least buffer_size characters'
+
+    chunk = []
+    size = 0
+    for piece in pieces:
+        chunk.append(piece)
+        size += len(piece)
+        if size >= buffer_size:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk)
 
 
 ################################
 # INTERFACE
 
+# Size of the pieces in which files are read
+_CHUNK_SIZE = 64 * 1024
+
+def _map_file(path):
+    'Returns the contents of a file, memory-mapped if it is a regular file'
+
+    f = open(path, 'rb')
+    try:
+        # Empty files cannot be mapped, and pipes and devices have no size
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+            return f.read()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+
+class XmlParser:
+    '''A reusable XML parser
+
+    The lexer and the SLR parser are built once, when the object is created,
+    and then shared by every document given to parse().
+
+    If a ContentHandler is given, the document is reported to it as it is
+    parsed and no document tree is built; parse() and close() then return
+    None.  If store is true, parse() builds a DocumentStore instead of a
+    tree and returns the view of its root element.
+
+    If a cache directory is given, the lexer tables and the parsing tables
+    are saved there and loaded back by the next parsers built from the same
+    rules.
+
+    Reductions are traced only if the parser debugging is enabled when the
+    object is created.  Otherwise, the grammar rules are bound as is, and
+    tracing costs nothing at parse time.
+    '''
+
+    def __init__(self, handler=None, store=False, cachedir=None):
+        self.xml_lexer = XmlLexer()
+        self.xml_lexer.build(cachedir=cachedir)
+        if cachedir:
+            binfile = os.path.join(cachedir, 'parsetab.bin')
+        else:
+            binfile = None
+        self.parser = yacc.yacc(method="SLR", binfile=binfile)
+
+        self.feeding = False
+
+        self.handler = handler
+        self.store = store
+        if handler is not None:
+            rules = _EventRules(handler)
+        elif store:
+            rules = self.store_rules = _StoreRules()
+            self.xml_lexer.use_spans()
+        else:
+            rules = None
+
+        if rules:
+            for production in self.parser.productions:
+                if production.callable:
+                    production.callable = getattr(rules, production.func[2:])
+
+        self.trace = _DEBUG['PARSER']
+        if self.trace:
+            for production in self.parser.productions:
+                if production.callable:
+                    production.callable = _traced(production.func, production.callable)
+
+    def parse(self, data):
+        '''Parses a whole document and returns its root element'''
+
+        self.feeding = False
+        if self.store:
+            self.store_rules.start(data)
+
+        _debug_header('INPUT')
+        _debug_print_('INPUT', data)
+        _debug_footer('INPUT')
+
+        # Tokenizer and parser share a single pass over the input; the
+        # tokens are only traced when the lexer debugging is enabled
+        if _DEBUG['LEXER']:
+            tokenfunc = self.xml_lexer.traced_token
+        else:
+            tokenfunc = None
+
+        _debug_header('LEXER')
+        _debug_header('PARSER')
+        self.xml_lexer.input(data)
+        root = self.parser.parse(lexer=self.xml_lexer.lexer, debug=False, tokenfunc=tokenfunc)
+        _debug_footer('PARSER')
+        _debug_footer('LEXER')
+
+        _debug_header('OUTPUT')
+        _debug_print_('OUTPUT', root)
+        _debug_footer('OUTPUT')
+
+        return root
+
+    def parse_file(self, path):
+        '''Parses a whole document from a file and returns its root element
+
+        The file is memory-mapped rather than read, so that its pages are
+        only loaded as the parser gets to them.  A DocumentStore keeps the
+        map as its data; otherwise the map is closed once the document is
+        parsed, since the tree holds copies of the text.
+        '''
+
+        data = _map_file(path)
+        if self.store or not isinstance(data, mmap.mmap):
+            return self.parse(data)
+
+        try:
+            return self.parse(data)
+        finally:
+            self.xml_lexer.input('')
+            data.close()
+
+    def feed(self, data):
+        '''Parses the next chunk of a document given piece by piece'''
+
+        self._push(data, False)
+
+    def close(self):
+        '''Ends a document given to feed() and returns its root element'''
+
+        self._push('', True)
+        self.feeding = False
+        root = self.parser.push_end()
+
+        _debug_header('OUTPUT')
+        _debug_print_('OUTPUT', root)
+        _debug_footer('OUTPUT')
+
+        return root
+
+    def _push(self, data, final):
+        if self.store:
+            raise ValueError('A document store is only built by parse()')
+
+        if not self.feeding:
+            self.xml_lexer.input('')
+            self.parser.push_start(self.xml_lexer.lexer)
+            self.feeding = True
+
+        try:
+            for tok in self.xml_lexer.feed(data, final):
+                self.parser.push(tok)
+        except:
+            self.feeding = False
+            raise
+
+
+class _IterHandler(ContentHandler):
+    '''Builds the elements of the current path and records the events'''
+
+    def __init__(self, events):
+        self.report_start = 'start' in events
+        self.report_end = 'end' in events
+        self.stack = []
+        self.events = []
+
+    def start_element(self, name, attributes):
+        element = DOM.Element(name, attributes, [])
+        if self.stack:
+            self.stack[-1].children.append(element)
+        self.stack.append(element)
+
+        if self.report_start:
+            self.events.append(('start', element))
+
+    def end_element(self, name):
+        element = self.stack.pop()
+
+        if self.report_end:
+            self.events.append(('end', element))
+
+    def characters(self, data):
+        if self.stack:
+            self.stack[-1].children.append(data)
+
+
+def iterparse(source, events=('start', 'end')):
+    '''Parses a document incrementally, yielding (event, element) pairs
+
+    source is a file name or a file object; a regular file given by its name
+    is memory-mapped and parsed in slices of the map, other files are read
+    in chunks.  A 'start' event is reported with the attributes of the
+    element, and an 'end' event once all of its children are parsed.
+    Elements are only kept by their ancestors, so once an element is
+    processed, calling clear() on its parent keeps the tree from growing
+    beyond the current path and the elements read ahead in the current
+    chunk of input.
+    '''
+
+    if isinstance(source, basestring):
+        f = open(source, 'rb')
+    else:
+        f = source
+
+    mapped = None
+    if f is not source:
+        st = os.fstat(f.fileno())
+        if stat.S_ISREG(st.st_mode) and st.st_size:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped is not None:
+        chunks = (mapped[i:i + _CHUNK_SIZE] for i in xrange(0, len(mapped), _CHUNK_SIZE))
+    else:
+        chunks = iter(lambda: f.read(_CHUNK_SIZE), '')
+
+    handler = _IterHandler(events)
+    xml_parser = XmlParser(handler)
+
+    try:
+        for data in chunks:
+            xml_parser.feed(data)
+
+            reported, handler.events = handler.events, []
+            for event in reported:
+                yield event
+
+        xml_parser.close()
+        for event in handler.events:
+            yield event
+
+    finally:
+        if mapped is not None:
+            mapped.close()
+        if f is not source:
+            f.close()
+
+
+_xml_parser = None
+
+def _xml_parser_instance():
+    global _xml_parser
+    if _xml_parser is None or _xml_parser.trace != _DEBUG['PARSER']:
+        _xml_parser = XmlParser()
+
+    return _xml_parser
+
 def xml_parse(data):
+    return _xml_parser_instance().parse(data)
+
+def xml_parse_file(path):
+    return _xml_parser_instance().parse_file(path)
+
+def _parse_item(item):
+    index, is_path, source, serialized = item
+    if is_path:
+        root = xml_parse_file(source)
+    else:
+        root = xml_parse(source)
+
+    if serialized:
+        root = str(root)
+    return index, root
+
+def parse_many(paths=(), blobs=(), workers=None, ordered=True, serialized=False, chunksize=8):
+    '''Parses many documents in a pool of processes
+
+    paths are file names and blobs the texts of documents; the documents of
+    paths come first, then those of blobs.  The parser is built before the
+    pool starts, so every worker has its own copy of it.  Yields the root
+    elements in the order of the documents, or with ordered false, (index,
+    root) pairs as soon as the documents are parsed.  With serialized, the
+    XML text of the documents is returned instead of their elements, which
+    is cheaper to send back than the pickled tree.  workers defaults to the
+    number of processors; with a single worker the documents are parsed in
+    this process.
+    '''
 
-    _debug_header('INPUT')
-    _debug_print_('INPUT', data)
-    _debug_footer('INPUT')
+    import multiprocessing
 
-    # Tokenizer
-    xml_lexer = XmlLexer()
-    xml_lexer.build()
+    if workers is None:
+        workers = multiprocessing.cpu_count()
 
-    _debug_header('LEXER')
-    xml_lexer.test(data)
-    _debug_footer('LEXER')
+    _xml_parser_instance()
+    sources = itertools.chain(((True, path) for path in paths),
+                              ((False, blob) for blob in blobs))
+    items = ((index, is_path, source, serialized)
+             for index, (is_path, source) in enumerate(sources))
 
-    # Parser
-    global tokens
-    tokens = XmlLexer.tokens
+    if workers <= 1:
+        for index, root in itertools.imap(_parse_item, items):
+            yield root if ordered else (index, root)
+        return
 
-    yacc.yacc(method="SLR")
+    pool = multiprocessing.Pool(workers)
+    try:
+        if ordered:
+            for index, root in pool.imap(_parse_item, items, chunksize):
+                yield root
+        else:
+            for result in pool.imap_unordered(_parse_item, items, chunksize):
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def xml_serialize(element, buffer_size=0):
+    '''Yields the XML text of an element and its descendants
+
+    Without a buffer_size, every tag and text is yielded as it is produced.
+    Otherwise they are joined into chunks of at least buffer_size characters.
+    '''
 
-    _debug_header('PARSER')
-    root = yacc.parse(data, lexer=xml_lexer.lexer, debug=False)
-    _debug_footer('PARSER')
+    if buffer_size > 0:
+        return _buffered(_serialize(element), buffer_size)
+    return _serialize(element)
 
-    _debug_header('OUTPUT')
-    _debug_print_('OUTPUT', root)
-    _debug_footer('OUTPUT')
+def xml_write(element, file, buffer_size=_CHUNK_SIZE):
+    'Writes the XML text of an element and its descendants to a file object'
 
-    return root
+    write = file.write
+    for chunk in xml_serialize(element, buffer_size):
+        write(chunk)
 
 
-def tree(node, level=0, init_prefix=''):
-    'Returns a tree view of the XML data'
+def walk(node):
+    '''Yields the start and end events of a document tree, as iterparse() does
+
+    The tree is walked with a stack of iterators over the children of the
+    open elements, so its depth is not limited by the recursion limit.
+    '''
+
+    yield 'start', node
+    stack = [(node, iter(node.children))]
+    while stack:
+        element, children = stack[-1]
+        for child in children:
+            if not isinstance(child, basestring):
+                yield 'start', child
+                stack.append((child, iter(child.children)))
+                break
+        else:
+            stack.pop()
+            yield 'end', element
+
+def copy_tree(node):
+    'Returns a DOM.Element copy of an element and its descendants'
+
+    def copy(element):
+        return DOM.Element(element.name, dict(element.attributes) or _NO_ATTRIBUTES, [])
+
+    root = copy(node)
+    stack = [(root, iter(node.children))]
+    while stack:
+        element, children = stack[-1]
+        for child in children:
+            if isinstance(child, basestring):
+                element.children.append(child)
+            else:
+                child_copy = copy(child)
+                element.children.append(child_copy)
+                stack.append((child_copy, iter(child.children)))
+                break
+        else:
+            stack.pop()
+            if not element.children:
+                element.children = _NO_CHILDREN
+
+    return root
+
+def equal_trees(a, b):
+    'Returns whether two elements have the same names, attributes and children'
+
+    stack = [(a, b)]
+    while stack:
+        a, b = stack.pop()
+        if a.name != b.name or a.attributes != b.attributes:
+            return False
+
+        a_children = a.children
+        b_children = b.children
+        if len(a_children) != len(b_children):
+            return False
+        for i in xrange(len(a_children)):
+            a_child = a_children[i]
+            b_child = b_children[i]
+            if isinstance(a_child, basestring) or isinstance(b_child, basestring):
+                if not (isinstance(a_child, basestring) and isinstance(b_child, basestring)
+                        and a_child == b_child):
+                    return False
+            else:
+                stack.append((a_child, b_child))
+
+    return True
+
+def _tree_lines(events, init_prefix='', clear=False):
+    '''Yields the lines of the tree view of a document, from its events
+
+    The line of an element shows its text when the text is its only child,
+    so it is written when its first child element starts, or else when it
+    ends.  With clear, the children of an element are dropped once they are
+    written, which keeps a tree built by iterparse() from growing.
+    '''
 
     prefix = '    '
     attr_prefix = '@'
     tag_postfix = ':\t'
     attr_postfix = ':\t'
 
-    s_node = init_prefix + node.name + tag_postfix
-    s_attributes = ''
-    s_children = ''
+    def lines(node, node_prefix, text):
+        L = [node_prefix + node.name + tag_postfix + text + '\n']
+        for attr in node.attributes:
+            L.append(node_prefix + prefix + attr_prefix + attr + attr_postfix + node.attributes[attr] + '\n')
+        return L
+
+    stack = []  # [element, prefix, written] for each open element
+    for event, element in events:
+        if event == 'start':
+            if stack:
+                parent = stack[-1]
+                if not parent[2]:
+                    parent[2] = True
+                    for line in lines(parent[0], parent[1], ''):
+                        yield line
+                stack.append([element, parent[1] + prefix, False])
+            else:
+                stack.append([element, init_prefix, False])
 
-    for attr in node.attributes:
-        s_attributes += init_prefix + prefix + attr_prefix + attr + attr_postfix + node.attributes[attr] + '\n'
+        else:
+            element, node_prefix, written = stack.pop()
+            if not written:
+                children = element.children
+                if len(children) == 1 and isinstance(children[0], basestring):
+                    text = children[0]
+                else:
+                    text = ''
+                for line in lines(element, node_prefix, text):
+                    yield line
 
-    if len(node.children) == 1 and not isinstance(node.children[0], DOM.Element):
-        s_node += node.children[0] + '\n'
+            # The parent is written since this element started
+            if clear and stack:
+                stack[-1][0].clear()
 
-    else:
-        for child in node.children:
-            if isinstance(child, DOM.Element):
-                s_children += tree(child, level+1, init_prefix + prefix)
+def iter_tree(node, init_prefix=''):
+    'Yields the lines of a tree view of the XML data'
 
-        s_node += '\n'
+    return _tree_lines(walk(node), init_prefix)
+
+def tree(node, level=0, init_prefix=''):
+    'Returns a tree view of the XML data'
 
-    return s_node + s_attributes + s_children
+    return ''.join(iter_tree(node, init_prefix))
 
 
 ################################
@@ -471,9 +1495,17 @@ def _debug_print_(part, s):
 # MAIN
 
 def main():
-    data = open(sys.argv[1]).read()
-    root = xml_parse(data)
-    print tree(root)
+    write = sys.stdout.write
+    try:
+        for line in _tree_lines(iterparse(sys.argv[1]), clear=True):
+            if isinstance(line, unicode):
+                line = line.encode('utf-8')
+            write(line)
+        write('\n')
+    except IOError, e:
+        # The reader of the output went away
+        if e.errno != errno.EPIPE:
+            raise
 
 if __name__ == '__main__':
     main()
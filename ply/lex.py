@@ -34,7 +34,13 @@
 __version__    = "3.2"
 __tabversion__ = "3.2"       # Version of table file used
 
-import re, sys, types, copy, os
+import re, sys, types, copy, os, marshal
+from array import array
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
 
 # This tuple contains known string types
 try:
@@ -66,7 +72,12 @@ class LexError(Exception):
          self.text = s
 
 # Token class.  This class is used to represent the tokens produced.
+# Tokens are created for every match, so their attributes are kept in slots
+# rather than in a dictionary.  lexend is only set on span tokens.  It is
+# not named endlexpos, which yacc uses for the start of the last token of a
+# symbol.
 class LexToken(object):
+    __slots__ = ('type','value','lineno','lexpos','lexend','lexer')
     def __str__(self):
         return "LexToken(%s,%r,%d,%d)" % (self.type,self.value,self.lineno,self.lexpos)
     def __repr__(self):
@@ -106,9 +117,16 @@ class NullLogger(object):
 #    input()          -  Store a new string in the lexer
 #    token()          -  Get the next token
 #    clone()          -  Clone the lexer
+#    scan()           -  Generate the tokens, with a scanner
+#    tokens_batch()   -  Get the next tokens, as arrays
+#    tokenize_all()   -  Get all the tokens of a string, as arrays
 #
 #    lineno           -  Current line number
 #    lexpos           -  Current position in the input string
+#    lexspans         -  Token types whose values are left as spans of the input
+#    lexbatchactions  -  Rule functions that tokens_batch() replaces by state changes
+#    lextokenlexer    -  If false, t.lexer is not set on the tokens passed to
+#                        rule functions, for rules using their own reference
 # -----------------------------------------------------------------------------
 
 class Lexer:
@@ -137,6 +155,12 @@ class Lexer:
         self.lexmodule = None         # Module
         self.lineno = 1               # Current line number
         self.lexoptimize = 0          # Optimized mode
+        self.lexspans = { }           # Token types whose values are left in the input
+        self.lextokenlexer = 1        # Set t.lexer on tokens passed to rule functions
+        self.lextypenames = None      # Token types, indexed by type id
+        self.lextypeids = None        # Dictionary mapping token types to type ids
+        self.lexbatchactions = { }    # State changes made by tokens_batch() instead of rule functions
+        self.lexscanre = { }          # Dictionary mapping lexer states to scanner regexs
 
     def clone(self,object=None):
         c = copy.copy(self)
@@ -245,6 +269,71 @@ class Lexer:
              self.lexstateerrorf[key] = fdict[ef]
         self.begin('INITIAL')
 
+    # ------------------------------------------------------------
+    # writecache() - Write lexer information to a cache file
+    #
+    # Unlike writetab(), the tables are written in marshal format, which
+    # is loaded without importing or compiling any Python code.
+    # ------------------------------------------------------------
+    def writecache(self,filename,signature):
+        tabre = { }
+        for key, lre in self.lexstatere.items():
+             titem = []
+             for i in range(len(lre)):
+                  titem.append((self.lexstateretext[key][i],_funcs_to_names(lre[i][1],self.lexstaterenames[key][i])))
+             tabre[key] = titem
+
+        taberr = { }
+        for key, ef in self.lexstateerrorf.items():
+             if ef:
+                  taberr[key] = ef.__name__
+             else:
+                  taberr[key] = None
+
+        tables = (__tabversion__, signature, self.lextokens, self.lexreflags, self.lexliterals,
+                  self.lexstateinfo, tabre, self.lexstaterenames, self.lexstateignore, taberr)
+
+        # Write to a temporary file first, so that the cache file is never
+        # seen partially written
+        tmpname = "%s.%d" % (filename, os.getpid())
+        tf = open(tmpname,"wb")
+        try:
+            marshal.dump(tables,tf)
+        finally:
+            tf.close()
+        os.rename(tmpname,filename)
+
+    # ------------------------------------------------------------
+    # readcache() - Read lexer information from a cache file
+    # ------------------------------------------------------------
+    def readcache(self,filename,signature,fdict):
+        tf = open(filename,"rb")
+        try:
+            tables = marshal.load(tf)
+        finally:
+            tf.close()
+
+        if tables[0] != __tabversion__ or tables[1] != signature:
+            raise ImportError("Inconsistent lexer cache")
+
+        (self.lextokens, self.lexreflags, self.lexliterals, self.lexstateinfo, tabre,
+         self.lexstaterenames, self.lexstateignore, taberr) = tables[2:]
+
+        self.lexstatere     = { }
+        self.lexstateretext = { }
+        for key,lre in tabre.items():
+             titem = []
+             txtitem = []
+             for i in range(len(lre)):
+                  titem.append((re.compile(lre[i][0],re.VERBOSE | self.lexreflags),_names_to_funcs(lre[i][1],fdict)))
+                  txtitem.append(lre[i][0])
+             self.lexstatere[key] = titem
+             self.lexstateretext[key] = txtitem
+        self.lexstateerrorf = { }
+        for key,ef in taberr.items():
+             self.lexstateerrorf[key] = ef and fdict[ef]
+        self.begin('INITIAL')
+
     # ------------------------------------------------------------
     # input() - Push a new string into the lexer
     # ------------------------------------------------------------
@@ -307,6 +396,8 @@ class Lexer:
         lexlen    = self.lexlen
         lexignore = self.lexignore
         lexdata   = self.lexdata
+        lexspans  = self.lexspans
+        lextokenlexer = self.lextokenlexer
 
         while lexpos < lexlen:
             # This code provides some short-circuit code for whitespace, tabs, and other ignored characters
@@ -321,13 +412,20 @@ class Lexer:
 
                 # Create a token for return
                 tok = LexToken()
-                tok.value = m.group()
                 tok.lineno = self.lineno
                 tok.lexpos = lexpos
 
                 i = m.lastindex
                 func,tok.type = lexindexfunc[i]
 
+                if lexspans and tok.type in lexspans:
+                    # The value is not copied out of the input.  It is
+                    # found between lexpos and lexend.
+                    tok.value = None
+                    tok.lexend = m.end()
+                else:
+                    tok.value = m.group()
+
                 if not func:
                    # If no token type was set, it's an ignored token
                    if tok.type:
@@ -341,7 +439,8 @@ class Lexer:
 
                 # If token is processed by a function, call it
 
-                tok.lexer = self      # Set additional attributes useful in token rules
+                if lextokenlexer:
+                    tok.lexer = self  # Set additional attributes useful in token rules
                 self.lexmatch = m
                 self.lexpos = lexpos
 
@@ -397,6 +496,287 @@ class Lexer:
              raise RuntimeError("No input string given with input()")
         return None
 
+    # ------------------------------------------------------------
+    # scan() - Generate the tokens with a scanner
+    #
+    # An alternative to calling token() for each token.  The master
+    # regex of the current state, preceded by its ignored characters,
+    # is matched again and again from where the last match ended, by a
+    # scanner object, so that most of the work is done by the re module.
+    # A new scanner is only created when a rule function changes the
+    # state or the position of the lexer.  Whatever the scanner can't
+    # match (literals, errors, trailing ignored characters, or states
+    # with several master regexes) is handed to token().
+    # ------------------------------------------------------------
+    def scan(self):
+        lexdata   = self.lexdata
+        lexlen    = self.lexlen
+        lexspans  = self.lexspans
+        lextokenlexer = self.lextokenlexer
+        lexscanre = self.lexscanre
+
+        while self.lexpos < lexlen:
+            lexre = self.lexre
+            if self.lexstate in lexscanre:
+                scanre = lexscanre[self.lexstate]
+            else:
+                scanre = self.scanre()
+            if scanre is None:
+                tok = self.token()
+                if tok is None:
+                    return
+                yield tok
+                continue
+
+            cre, lexindexfunc = scanre
+            match = cre.scanner(lexdata,self.lexpos).match
+            while 1:
+                m = match()
+                if m is None:
+                    # Let token() deal with it
+                    tok = self.token()
+                    if tok is None:
+                        return
+                    yield tok
+                    break
+
+                i = m.lastindex
+                func,toktype = lexindexfunc[i]
+                end = m.end()
+
+                tok = LexToken()
+                tok.lineno = self.lineno
+                tok.lexpos = m.start(i)
+                tok.type = toktype
+
+                if lexspans and toktype in lexspans:
+                    tok.value = None
+                    tok.lexend = end
+                else:
+                    tok.value = m.group(i)
+
+                self.lexpos = end
+                if not func:
+                    # If no token type was set, it's an ignored token
+                    if toktype:
+                        yield tok
+                else:
+                    # If token is processed by a function, call it
+                    if lextokenlexer:
+                        tok.lexer = self
+                    self.lexmatch = m
+                    newtok = func(tok)
+
+                    if newtok:
+                        # Verify type of the token.  If not in the token map, raise an error
+                        if not self.lexoptimize:
+                            if not newtok.type in self.lextokens:
+                                raise LexError("%s:%d: Rule '%s' returned an unknown token type '%s'" % (
+                                    func_code(func).co_filename, func_code(func).co_firstlineno,
+                                    func.__name__, newtok.type),lexdata[tok.lexpos:])
+                        yield newtok
+
+                # Start over if the state or the position has changed
+                if self.lexre is not lexre or self.lexpos != end:
+                    break
+
+    # Returns the scanner regex of the current state and its rules, or None
+    # if the state has several master regexes
+    def scanre(self):
+        state = self.lexstate
+        if state not in self.lexscanre:
+            if len(self.lexre) == 1:
+                ignore = "".join([re.escape(c) for c in self.lexignore])
+                if ignore:
+                    text = "(?:[%s])*(?:%s)" % (ignore,self.lexretext[0])
+                else:
+                    text = self.lexretext[0]
+                cre = re.compile(text,re.VERBOSE | self.lexreflags)
+                self.lexscanre[state] = (cre,self.lexre[0][1])
+            else:
+                self.lexscanre[state] = None
+        return self.lexscanre[state]
+
+    # ------------------------------------------------------------
+    # tokens_batch() - Scan up to n tokens into arrays
+    #
+    # Returns four arrays of the same length: the type ids, start and
+    # end positions and line numbers of the tokens.  Type ids index the
+    # list returned by typenames().  The token values are not kept: a
+    # token is found between its start and end in the input.  Rule
+    # functions are still called, so that they can change the type of
+    # a token, discard it, or change the state of the lexer, unless
+    # lexbatchactions has an action for the token type: ('push',state)
+    # or ('pop',) to change the state, or () if the function only
+    # computes the value.  Fewer than n tokens are returned at the end
+    # of the input only.
+    # ------------------------------------------------------------
+    def tokens_batch(self,n):
+        typeid    = self.typeids()
+        types     = array('i',[0]) * n
+        starts    = array('l',[0]) * n
+        ends      = array('l',[0]) * n
+        lines     = array('l',[0]) * n
+        count     = 0
+
+        lexpos    = self.lexpos
+        lexlen    = self.lexlen
+        lexignore = self.lexignore
+        lexdata   = self.lexdata
+        lexspans  = self.lexspans
+        lextokenlexer = self.lextokenlexer
+        batchactions = self.lexbatchactions
+
+        while count < n and lexpos < lexlen:
+            if lexdata[lexpos] in lexignore:
+                lexpos += 1
+                continue
+
+            # Look for a regular expression match
+            for lexre,lexindexfunc in self.lexre:
+                m = lexre.match(lexdata,lexpos)
+                if not m: continue
+
+                func,tokname = lexindexfunc[m.lastindex]
+                end = m.end()
+
+                if not func:
+                    # If no token type was set, it's an ignored token
+                    if tokname:
+                        types[count] = typeid[tokname]
+                        starts[count] = lexpos
+                        ends[count] = end
+                        lines[count] = self.lineno
+                        count += 1
+                    lexpos = end
+                    break
+
+                # The rule function may be replaced by a batch action
+                if batchactions and tokname in batchactions:
+                    types[count] = typeid[tokname]
+                    starts[count] = lexpos
+                    ends[count] = end
+                    lines[count] = self.lineno
+                    count += 1
+                    lexpos = end
+                    action = batchactions[tokname]
+                    if action:
+                        if action[0] == 'push':
+                            self.push_state(action[1])
+                        else:
+                            self.pop_state()
+                        lexignore = self.lexignore
+                    break
+
+                # The token is processed by a function, which may change
+                # the lexer state or position
+                tok = LexToken()
+                tok.lineno = self.lineno
+                tok.lexpos = lexpos
+                tok.type = tokname
+                if lexspans and tokname in lexspans:
+                    tok.value = None
+                    tok.lexend = end
+                else:
+                    tok.value = m.group()
+                if lextokenlexer:
+                    tok.lexer = self
+                self.lexmatch = m
+                self.lexpos = end
+
+                newtok = func(tok)
+
+                if newtok:
+                    types[count] = typeid[newtok.type]
+                    starts[count] = newtok.lexpos
+                    ends[count] = end
+                    lines[count] = newtok.lineno
+                    count += 1
+                lexpos    = self.lexpos
+                lexignore = self.lexignore      # This is here in case there was a state change
+                break
+            else:
+                # No match, see if in literals
+                if lexdata[lexpos] in self.lexliterals:
+                    types[count] = typeid[lexdata[lexpos]]
+                    starts[count] = lexpos
+                    ends[count] = lexpos + 1
+                    lines[count] = self.lineno
+                    count += 1
+                    lexpos += 1
+                    continue
+
+                # No match. Call t_error() if defined.
+                if self.lexerrorf:
+                    tok = LexToken()
+                    tok.value = lexdata[lexpos:]
+                    tok.lineno = self.lineno
+                    tok.type = "error"
+                    tok.lexer = self
+                    tok.lexpos = lexpos
+                    self.lexpos = lexpos
+                    newtok = self.lexerrorf(tok)
+                    if lexpos == self.lexpos:
+                        # Error method didn't change text position at all. This is an error.
+                        raise LexError("Scanning error. Illegal character '%s'" % (lexdata[lexpos]), lexdata[lexpos:])
+                    if newtok:
+                        types[count] = typeid[newtok.type]
+                        starts[count] = lexpos
+                        ends[count] = self.lexpos
+                        lines[count] = newtok.lineno
+                        count += 1
+                    lexpos = self.lexpos
+                    continue
+
+                self.lexpos = lexpos
+                raise LexError("Illegal character '%s' at index %d" % (lexdata[lexpos],lexpos), lexdata[lexpos:])
+
+        self.lexpos = lexpos
+        if self.lexdata is None:
+             raise RuntimeError("No input string given with input()")
+
+        if count < n:
+            del types[count:]
+            del starts[count:]
+            del ends[count:]
+            del lines[count:]
+        return types, starts, ends, lines
+
+    # ------------------------------------------------------------
+    # tokenize_all() - Scan a whole input into arrays
+    #
+    # Returns the arrays of tokens_batch() for all the tokens of data.
+    # ------------------------------------------------------------
+    def tokenize_all(self,data,batch=4096):
+        self.input(data)
+        arrays = more = self.tokens_batch(batch)
+        while len(more[0]) == batch:
+            more = self.tokens_batch(batch)
+            for a, b in zip(arrays,more):
+                a.extend(b)
+        return arrays
+
+    # ------------------------------------------------------------
+    # typenames() - Token types, in the order of their type ids
+    # typeids()   - Type id of each token type
+    # ------------------------------------------------------------
+    def typenames(self):
+        if self.lextypenames is None:
+            names = sorted(self.lextokens)
+            for c in self.lexliterals:
+                if c not in names:
+                    names.append(c)
+            if "error" not in names:
+                names.append("error")
+            self.lextypenames = names
+            self.lextypeids = dict([(name,i) for i,name in enumerate(names)])
+        return self.lextypenames
+
+    def typeids(self):
+        if self.lextypeids is None:
+            self.typenames()
+        return self.lextypeids
+
     # Iterator interface
     def __iter__(self):
         return self
@@ -570,6 +950,25 @@ class LexerReflect(object):
         self.validate_rules()
         return self.error
 
+    # Compute a signature over the lexer rules, identifying the tables
+    # built from them
+    def signature(self):
+        parts = [__tabversion__, "%d.%d" % sys.version_info[:2], repr(self.reflags),
+                 " ".join(self.tokens), repr(self.literals)]
+        for state in sorted(self.stateinfo):
+            parts.append("%s %s %r" % (state, self.stateinfo[state], self.ignore.get(state)))
+            errorf = self.errorf.get(state)
+            if errorf:
+                parts.append(errorf.__name__)
+            for fname, f in self.funcsym[state]:
+                parts.append("%s %s" % (fname, f.__doc__))
+            for name, r in self.strsym[state]:
+                parts.append("%s %s" % (name, r))
+        # repr() keeps rules with non-ASCII characters apart, whatever their type
+        sig = md5()
+        sig.update(repr(parts).encode('utf-8'))
+        return sig.hexdigest()
+
     # Get the tokens map
     def get_tokens(self):
         tokens = self.ldict.get("tokens",None)
@@ -862,7 +1261,7 @@ class LexerReflect(object):
 #
 # Build all of the regular expression rules from definitions in the supplied module
 # -----------------------------------------------------------------------------
-def lex(module=None,object=None,debug=0,optimize=0,lextab="lextab",reflags=0,nowarn=0,outputdir="", debuglog=None, errorlog=None):
+def lex(module=None,object=None,debug=0,optimize=0,lextab="lextab",reflags=0,nowarn=0,outputdir="", debuglog=None, errorlog=None, cachedir=None):
     global lexer
     ldict = None
     stateinfo  = { 'INITIAL' : 'inclusive'}
@@ -889,6 +1288,22 @@ def lex(module=None,object=None,debug=0,optimize=0,lextab="lextab",reflags=0,now
     # Collect parser information from the dictionary
     linfo = LexerReflect(ldict,log=errorlog,reflags=reflags)
     linfo.get_all()
+
+    # If a cache directory is given, try to load the tables built from the
+    # very same rules, skipping validation
+    if cachedir:
+        signature = linfo.signature()
+        cachefile = os.path.join(cachedir,"lextab-%s" % signature)
+        try:
+            lexobj.readcache(cachefile,signature,ldict)
+            token = lexobj.token
+            input = lexobj.input
+            lexer = lexobj
+            return lexobj
+
+        except (IOError,EOFError,ValueError,TypeError,KeyError,ImportError):
+            pass
+
     if not optimize:
         if linfo.validate_all():
             raise SyntaxError("Can't build lexer")
@@ -1002,6 +1417,14 @@ def lex(module=None,object=None,debug=0,optimize=0,lextab="lextab",reflags=0,now
     if lextab and optimize:
         lexobj.writetab(lextab,outputdir)
 
+    # Cache the tables for the next time
+    if cachedir:
+        try:
+            lexobj.writecache(cachefile,signature)
+        except (IOError,OSError):
+            e = sys.exc_info()[1]
+            errorlog.warning("Couldn't write lexer cache '%s': %s", cachefile, e)
+
     return lexobj
 
 # -----------------------------------------------------------------------------
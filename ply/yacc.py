@@ -82,9 +82,10 @@ yaccdevel   = 0                # Set to True if developing yacc.  This turns off
 
 resultlimit = 40               # Size limit of results when running in debug mode.
 
-pickle_protocol = 0            # Protocol to use when writing pickle files
+pickle_protocol = 2            # Protocol to use when writing pickle files
 
-import re, types, sys, os.path
+import re, types, sys, os.path, marshal
+from array import array
 
 # Compatibility function for python 2.6/3.0
 if sys.version_info[0] < 3:
@@ -186,7 +187,8 @@ class YaccSymbol:
 # item (or 0 if not defined).   The linespan() method returns
 # a tuple of (startline,endline) representing the range of lines
 # for a symbol.  The lexspan() method returns a tuple (lexpos,endlexpos)
-# representing the range of positional information for a symbol.
+# representing the range of positional information for a symbol.  The
+# lexend() method returns the end of the input left in a span token.
 
 class YaccProduction:
     def __init__(self,s,stack=None):
@@ -226,10 +228,101 @@ class YaccProduction:
         endpos = getattr(self.slice[n],"endlexpos",startpos)
         return startpos,endpos
 
+    def lexend(self,n):
+        return getattr(self.slice[n],"lexend",0)
+
+    def error(self):
+       raise SyntaxError
+
+# This class is the object passed to grammar rules by the parsing engines
+# that do not track positions.  It has the interface of YaccProduction, but
+# reads the symbols of the production in place, at the top of the symbol
+# stack above index base, instead of from a list sliced out of it.  The
+# value of p[0] is kept in the result symbol.  The slice attribute is only
+# built when a rule asks for it.
+
+class YaccStackProduction:
+    def __init__(self,stack):
+        self.stack = stack
+        self.base = 0
+        self.result = YaccSymbol()
+        self.lexer = None
+        self.parser= None
+
+    def __getattr__(self,name):
+        if name == 'slice':
+            return [self.result] + self.stack[self.base+1:]
+        raise AttributeError(name)
+
+    def __getitem__(self,n):
+        if n > 0: return self.stack[self.base+n].value
+        elif n == 0: return self.result.value
+        else: return self.stack[self.base+1+n].value
+
+    def __setitem__(self,n,v):
+        if n: self.stack[self.base+n].value = v
+        else: self.result.value = v
+
+    def __getslice__(self,i,j):
+        return [s.value for s in self.slice[i:j]]
+
+    def __len__(self):
+        return len(self.stack) - self.base
+
+    def _symbol(self,n):
+        if n: return self.stack[self.base+n]
+        else: return self.result
+
+    def lineno(self,n):
+        return getattr(self._symbol(n),"lineno",0)
+
+    def set_lineno(self,n,lineno):
+        self._symbol(n).lineno = lineno
+
+    def linespan(self,n):
+        startline = getattr(self._symbol(n),"lineno",0)
+        endline = getattr(self._symbol(n),"endlineno",startline)
+        return startline,endline
+
+    def lexpos(self,n):
+        return getattr(self._symbol(n),"lexpos",0)
+
+    def lexspan(self,n):
+        startpos = getattr(self._symbol(n),"lexpos",0)
+        endpos = getattr(self._symbol(n),"endlexpos",startpos)
+        return startpos,endpos
+
+    def lexend(self,n):
+        return getattr(self._symbol(n),"lexend",0)
+
     def error(self):
        raise SyntaxError
 
 
+# Rules that write_module() can inline: p[0] = p[n], and rules doing nothing.
+# The code of a rule is compared to the code of these, leaving out docstrings.
+def _rule_code(f):
+    code = func_code(f)
+    consts = tuple([c for c in code.co_consts if not isinstance(c,str)])
+    return (code.co_code, consts, code.co_names)
+
+def _rule_template(body):
+    namespace = { }
+    exec("def rule(p):\n    'docstring'\n    %s\n" % body, namespace)
+    return _rule_code(namespace['rule'])
+
+# Returns n for a rule copying p[n], 0 for a rule doing nothing, else None
+def _inlined_rule(f,plen):
+    if not isinstance(f,types.FunctionType):
+        return None
+    code = _rule_code(f)
+    if code == _rule_template("pass"):
+        return 0
+    for n in range(1,plen + 1):
+        if code == _rule_template("p[0] = p[%d]" % n):
+            return n
+    return None
+
 # -----------------------------------------------------------------------------
 #                               == LRParser ==
 #
@@ -242,6 +335,41 @@ class LRParser:
         self.action      = lrtab.lr_action
         self.goto        = lrtab.lr_goto
         self.errorfunc   = errorf
+        self.dense       = None
+
+    # -----------------------------------------------------------------------------
+    # use_dense_tables()
+    #
+    # Translates the action and goto tables into lists indexed by integers.
+    # Every symbol gets a small id, and each state gets one list holding its
+    # actions in the columns of the terminals and its gotos in the columns of
+    # the nonterminals.  Id 0 is never used by a symbol, so its column stays
+    # empty and unknown token types find no action.  parse() then uses
+    # parseopt_dense() unless debugging or tracking is requested.
+    # -----------------------------------------------------------------------------
+
+    def use_dense_tables(self):
+        symbolid = { }
+        for table in (self.action, self.goto):
+            for row in table.values():
+                for name in row:
+                    if name not in symbolid:
+                        symbolid[name] = len(symbolid) + 1
+        for p in self.productions:
+            if p.name not in symbolid:
+                symbolid[p.name] = len(symbolid) + 1
+
+        nstates = max(self.action) + 1
+        width = len(symbolid) + 1
+        rows = [ ]
+        for state in range(nstates):
+            row = [None] * width
+            for table in (self.action, self.goto):
+                for name, v in table.get(state,{}).items():
+                    row[symbolid[name]] = v
+            rows.append(row)
+
+        self.dense = (symbolid, rows, [symbolid[p.name] for p in self.productions])
 
     def errok(self):
         self.errorok     = 1
@@ -261,6 +389,8 @@ class LRParser:
             return self.parsedebug(input,lexer,debug,tracking,tokenfunc)
         elif tracking:
             return self.parseopt(input,lexer,debug,tracking,tokenfunc)
+        elif self.dense:
+            return self.parseopt_dense(input,lexer,debug,tracking,tokenfunc)
         else:
             return self.parseopt_notrack(input,lexer,debug,tracking,tokenfunc)
         
@@ -863,7 +993,9 @@ class LRParser:
     #
     # Optimized version of parseopt() with line number tracking removed. 
     # DO NOT EDIT THIS CODE DIRECTLY. Copy the optimized version and remove
-    # code in the #--! TRACKING sections
+    # code in the #--! TRACKING sections.  Then replace the reduction with
+    # the one below, which passes a YaccStackProduction to the grammar rules
+    # and allocates neither a slice nor, most of the time, a YaccSymbol.
     # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 
     def parseopt_notrack(self,input=None,lexer=None,debug=0,tracking=0,tokenfunc=None):
@@ -872,7 +1004,7 @@ class LRParser:
         actions = self.action            # Local reference to action table (to avoid lookup on self.)
         goto    = self.goto              # Local reference to goto table (to avoid lookup on self.)
         prod    = self.productions       # Local reference to production list (to avoid lookup on self.)
-        pslice  = YaccProduction(None)   # Production object passed to grammar rules
+        pslice  = YaccStackProduction(None)   # Production object passed to grammar rules
         errorcount = 0                   # Used during error recovery 
 
         # If no lexer was given, we will try to use the lex module
@@ -902,6 +1034,7 @@ class LRParser:
         self.symstack = symstack
 
         pslice.stack = symstack         # Put in the production
+        result = pslice.result          # Symbol holding p[0]
         errtoken   = None               # Err token
 
         # The start state is assumed to be (0,$end)
@@ -948,72 +1081,306 @@ class LRParser:
                     pname = p.name
                     plen  = p.len
 
-                    # Get production function
-                    sym = YaccSymbol()
-                    sym.type = pname       # Production name
-                    sym.value = None
-
-                    if plen:
-                        targ = symstack[-plen-1:]
-                        targ[0] = sym
+                    # The rule reads its symbols in place, on the stack
+                    base = len(symstack) - plen - 1
+                    pslice.base = base
+                    result.value = None
 
-                        # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-                        # The code enclosed in this section is duplicated 
-                        # below as a performance optimization.  Make sure
-                        # changes get made in both locations.
+                    # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+                    # The code enclosed in this section is duplicated 
+                    # in push() as a performance optimization.  Make sure
+                    # changes get made in both locations.
 
-                        pslice.slice = targ
-                        
-                        try:
-                            # Call the grammar rule with our special slice object
-                            del symstack[-plen:]
+                    try:
+                        # Call the grammar rule with our special stack view
+                        if plen:
                             del statestack[-plen:]
-                            p.callable(pslice)
-                            symstack.append(sym)
-                            state = goto[statestack[-1]][pname]
-                            statestack.append(state)
-                        except SyntaxError:
-                            # If an error was set. Enter error recovery state
-                            lookaheadstack.append(lookahead)
-                            symstack.pop()
-                            statestack.pop()
-                            state = statestack[-1]
-                            sym.type = 'error'
-                            lookahead = sym
-                            errorcount = error_count
-                            self.errorok = 0
-                        continue
-                        # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-    
+                        p.callable(pslice)
+
+                        # The symbol holding p[0] is pushed, with whatever
+                        # else the rule set on it.  The first symbol of the
+                        # production is popped and, emptied, holds p[0] for
+                        # the next rule, unless it is a token
+                        sym = result
+                        sym.type = pname       # Production name
+                        if plen:
+                            result = symstack[base+1]
+                            del symstack[base+1:]
+                            if result.__class__ is YaccSymbol:
+                                result.__dict__.clear()
+                            else:
+                                result = YaccSymbol()
+                        else:
+                            result = YaccSymbol()
+                        pslice.result = result
+                        symstack.append(sym)
+                        state = goto[statestack[-1]][pname]
+                        statestack.append(state)
+                    except SyntaxError:
+                        # If an error was set. Enter error recovery state
+                        result.__dict__.clear()
+                        del symstack[base+1:]
+                        lookaheadstack.append(lookahead)
+                        symstack.pop()
+                        statestack.pop()
+                        state = statestack[-1]
+                        sym = YaccSymbol()
+                        sym.type = 'error'
+                        sym.value = None
+                        lookahead = sym
+                        errorcount = error_count
+                        self.errorok = 0
+                    continue
+                    # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+
+                if t == 0:
+                    n = symstack[-1]
+                    return getattr(n,"value",None)
+
+            if t == None:
+
+                # We have some kind of parsing error here.  To handle
+                # this, we are going to push the current token onto
+                # the tokenstack and replace it with an 'error' token.
+                # If there are any synchronization rules, they may
+                # catch it.
+                #
+                # In addition to pushing the error token, we call call
+                # the user defined p_error() function if this is the
+                # first syntax error.  This function is only called if
+                # errorcount == 0.
+                if errorcount == 0 or self.errorok:
+                    errorcount = error_count
+                    self.errorok = 0
+                    errtoken = lookahead
+                    if errtoken.type == '$end':
+                        errtoken = None               # End of file!
+                    if self.errorfunc:
+                        global errok,token,restart
+                        errok = self.errok        # Set some special functions available in error recovery
+                        token = get_token
+                        restart = self.restart
+                        if errtoken and not hasattr(errtoken,'lexer'):
+                            errtoken.lexer = lexer
+                        tok = self.errorfunc(errtoken)
+                        del errok, token, restart   # Delete special functions
+
+                        if self.errorok:
+                            # User must have done some kind of panic
+                            # mode recovery on their own.  The
+                            # returned token is the next lookahead
+                            lookahead = tok
+                            errtoken = None
+                            continue
                     else:
+                        if errtoken:
+                            if hasattr(errtoken,"lineno"): lineno = lookahead.lineno
+                            else: lineno = 0
+                            if lineno:
+                                sys.stderr.write("yacc: Syntax error at line %d, token=%s\n" % (lineno, errtoken.type))
+                            else:
+                                sys.stderr.write("yacc: Syntax error, token=%s" % errtoken.type)
+                        else:
+                            sys.stderr.write("yacc: Parse error in input. EOF\n")
+                            return
 
-                        targ = [ sym ]
+                else:
+                    errorcount = error_count
 
-                        # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-                        # The code enclosed in this section is duplicated 
-                        # above as a performance optimization.  Make sure
-                        # changes get made in both locations.
+                # case 1:  the statestack only has 1 entry on it.  If we're in this state, the
+                # entire parse has been rolled back and we're completely hosed.   The token is
+                # discarded and we just keep going.
 
-                        pslice.slice = targ
+                if len(statestack) <= 1 and lookahead.type != '$end':
+                    lookahead = None
+                    errtoken = None
+                    state = 0
+                    # Nuke the pushback stack
+                    del lookaheadstack[:]
+                    continue
 
-                        try:
-                            # Call the grammar rule with our special slice object
-                            p.callable(pslice)
-                            symstack.append(sym)
-                            state = goto[statestack[-1]][pname]
-                            statestack.append(state)
-                        except SyntaxError:
-                            # If an error was set. Enter error recovery state
-                            lookaheadstack.append(lookahead)
-                            symstack.pop()
-                            statestack.pop()
-                            state = statestack[-1]
-                            sym.type = 'error'
-                            lookahead = sym
-                            errorcount = error_count
-                            self.errorok = 0
+                # case 2: the statestack has a couple of entries on it, but we're
+                # at the end of the file. nuke the top entry and generate an error token
+
+                # Start nuking entries on the stack
+                if lookahead.type == '$end':
+                    # Whoa. We're really hosed here. Bail out
+                    return
+
+                if lookahead.type != 'error':
+                    sym = symstack[-1]
+                    if sym.type == 'error':
+                        # Hmmm. Error is on top of stack, we'll just nuke input
+                        # symbol and continue
+                        lookahead = None
                         continue
-                        # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+                    t = YaccSymbol()
+                    t.type = 'error'
+                    if hasattr(lookahead,"lineno"):
+                        t.lineno = lookahead.lineno
+                    t.value = lookahead
+                    lookaheadstack.append(lookahead)
+                    lookahead = t
+                else:
+                    symstack.pop()
+                    statestack.pop()
+                    state = statestack[-1]       # Potential bug fix
+
+                continue
+
+            # Call an error function here
+            raise RuntimeError("yacc: internal parser error!!!\n")
+
+    # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+    # parseopt_dense().
+    #
+    # Version of parseopt_notrack() that runs on the tables built by
+    # use_dense_tables().  Each action and goto is found by indexing lists
+    # with the state and the symbol id instead of hashing the symbol name.
+    # DO NOT EDIT THIS CODE DIRECTLY. Copy parseopt_notrack() and replace
+    # the table lookups.
+    # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+
+    def parseopt_dense(self,input=None,lexer=None,debug=0,tracking=0,tokenfunc=None):
+        lookahead = None                 # Current lookahead symbol
+        lookaheadstack = [ ]             # Stack of lookahead symbols
+        symbolid, rows, prodid = self.dense   # Dense tables built by use_dense_tables()
+        prod    = self.productions       # Local reference to production list (to avoid lookup on self.)
+        lid     = None                   # Symbol id of the lookahead
+        pslice  = YaccStackProduction(None)   # Production object passed to grammar rules
+        errorcount = 0                   # Used during error recovery 
+
+        # If no lexer was given, we will try to use the lex module
+        if not lexer:
+            lex = load_ply_lex()
+            lexer = lex.lexer
+        
+        # Set up the lexer and parser objects on pslice
+        pslice.lexer = lexer
+        pslice.parser = self
+
+        # If input was supplied, pass to lexer
+        if input is not None:
+            lexer.input(input)
+
+        if tokenfunc is None:
+           # Tokenize function
+           get_token = lexer.token
+        else:
+           get_token = tokenfunc
+
+        # Set up the state and symbol stacks
+
+        statestack = [ ]                # Stack of parsing states
+        self.statestack = statestack
+        symstack   = [ ]                # Stack of grammar symbols
+        self.symstack = symstack
+
+        pslice.stack = symstack         # Put in the production
+        result = pslice.result          # Symbol holding p[0]
+        errtoken   = None               # Err token
+
+        # The start state is assumed to be (0,$end)
+
+        statestack.append(0)
+        sym = YaccSymbol()
+        sym.type = '$end'
+        symstack.append(sym)
+        state = 0
+        while 1:
+            # Get the next symbol on the input.  If a lookahead symbol
+            # is already set, we just use that. Otherwise, we'll pull
+            # the next token off of the lookaheadstack or from the lexer
+
+            if not lookahead:
+                if not lookaheadstack:
+                    lookahead = get_token()     # Get the next token
+                else:
+                    lookahead = lookaheadstack.pop()
+                if not lookahead:
+                    lookahead = YaccSymbol()
+                    lookahead.type = '$end'
+                lid = None
+
+            # Look up the symbol id once per lookahead
+            if lid is None:
+                lid = symbolid.get(lookahead.type,0)
+
+            # Check the action table
+            t = rows[state][lid]
+
+            if t is not None:
+                if t > 0:
+                    # shift a symbol on the stack
+                    statestack.append(t)
+                    state = t
+
+                    symstack.append(lookahead)
+                    lookahead = None
+
+                    # Decrease error count on successful shift
+                    if errorcount: errorcount -=1
+                    continue
+
+                if t < 0:
+                    # reduce a symbol on the stack, emit a production
+                    p = prod[-t]
+                    pname = p.name
+                    plen  = p.len
+                    pid   = prodid[-t]
+
+                    # The rule reads its symbols in place, on the stack
+                    base = len(symstack) - plen - 1
+                    pslice.base = base
+                    result.value = None
+
+                    # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+                    # The code enclosed in this section is duplicated 
+                    # in push() as a performance optimization.  Make sure
+                    # changes get made in both locations.
+
+                    try:
+                        # Call the grammar rule with our special stack view
+                        if plen:
+                            del statestack[-plen:]
+                        p.callable(pslice)
+
+                        # The symbol holding p[0] is pushed, with whatever
+                        # else the rule set on it.  The first symbol of the
+                        # production is popped and, emptied, holds p[0] for
+                        # the next rule, unless it is a token
+                        sym = result
+                        sym.type = pname       # Production name
+                        if plen:
+                            result = symstack[base+1]
+                            del symstack[base+1:]
+                            if result.__class__ is YaccSymbol:
+                                result.__dict__.clear()
+                            else:
+                                result = YaccSymbol()
+                        else:
+                            result = YaccSymbol()
+                        pslice.result = result
+                        symstack.append(sym)
+                        state = rows[statestack[-1]][pid]
+                        statestack.append(state)
+                    except SyntaxError:
+                        # If an error was set. Enter error recovery state
+                        result.__dict__.clear()
+                        del symstack[base+1:]
+                        lookaheadstack.append(lookahead)
+                        symstack.pop()
+                        statestack.pop()
+                        state = statestack[-1]
+                        sym = YaccSymbol()
+                        sym.type = 'error'
+                        sym.value = None
+                        lookahead = sym
+                        lid = None
+                        errorcount = error_count
+                        self.errorok = 0
+                    continue
+                    # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 
                 if t == 0:
                     n = symstack[-1]
@@ -1052,6 +1419,7 @@ class LRParser:
                             # mode recovery on their own.  The
                             # returned token is the next lookahead
                             lookahead = tok
+                            lid = None
                             errtoken = None
                             continue
                     else:
@@ -1089,6 +1457,225 @@ class LRParser:
                     # Whoa. We're really hosed here. Bail out
                     return
 
+                if lookahead.type != 'error':
+                    sym = symstack[-1]
+                    if sym.type == 'error':
+                        # Hmmm. Error is on top of stack, we'll just nuke input
+                        # symbol and continue
+                        lookahead = None
+                        continue
+                    t = YaccSymbol()
+                    t.type = 'error'
+                    if hasattr(lookahead,"lineno"):
+                        t.lineno = lookahead.lineno
+                    t.value = lookahead
+                    lookaheadstack.append(lookahead)
+                    lookahead = t
+                    lid = None
+                else:
+                    symstack.pop()
+                    statestack.pop()
+                    state = statestack[-1]       # Potential bug fix
+
+                continue
+
+            # Call an error function here
+            raise RuntimeError("yacc: internal parser error!!!\n")
+
+    # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+    # push_start(), push(), push_end()
+    #
+    # Push interface to the parser.  Instead of pulling tokens from a lexer,
+    # the parser is handed one token at a time by the caller, which makes it
+    # possible to parse input that arrives in pieces.  push_start() begins a
+    # new parse, push() feeds it the next token and push_end() marks the end
+    # of the input and returns the result.
+    #
+    # push() is a version of parseopt_notrack() that returns to the caller
+    # whenever it needs another token.  Make sure changes to the parsing
+    # engine get made here too.
+    # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+
+    def push_start(self,lexer=None):
+        pslice = YaccStackProduction(None)   # Production object passed to grammar rules
+        pslice.lexer = lexer
+        pslice.parser = self
+
+        # Set up the state and symbol stacks
+        self.statestack = [ 0 ]
+        sym = YaccSymbol()
+        sym.type = '$end'
+        self.symstack = [ sym ]
+        pslice.stack = self.symstack
+
+        self.pushslice = pslice
+        self.pushlookaheadstack = [ ]
+        self.pusherrorcount = 0
+        self.pushdone = 0
+        self.pushresult = None
+
+    def push(self,lookahead):
+        if self.pushdone:
+            raise YaccError("Parser does not expect any more input")
+
+        lookaheadstack = self.pushlookaheadstack
+        actions = self.action            # Local reference to action table (to avoid lookup on self.)
+        goto    = self.goto              # Local reference to goto table (to avoid lookup on self.)
+        prod    = self.productions       # Local reference to production list (to avoid lookup on self.)
+        pslice  = self.pushslice
+        result  = pslice.result          # Symbol holding p[0]
+        errorcount = self.pusherrorcount
+        statestack = self.statestack
+        symstack   = self.symstack
+        state = statestack[-1]
+
+        while 1:
+            # Use the pushed token, then any symbol left on the lookaheadstack.
+            # Once they are all consumed, wait for the next call.
+
+            if not lookahead:
+                if not lookaheadstack:
+                    self.pusherrorcount = errorcount
+                    return
+                lookahead = lookaheadstack.pop()
+
+            # Check the action table
+            ltype = lookahead.type
+            t = actions[state].get(ltype)
+
+            if t is not None:
+                if t > 0:
+                    # shift a symbol on the stack
+                    statestack.append(t)
+                    state = t
+
+                    symstack.append(lookahead)
+                    lookahead = None
+
+                    # Decrease error count on successful shift
+                    if errorcount: errorcount -=1
+                    continue
+
+                if t < 0:
+                    # reduce a symbol on the stack, emit a production
+                    p = prod[-t]
+                    pname = p.name
+                    plen  = p.len
+
+                    # The rule reads its symbols in place, on the stack
+                    base = len(symstack) - plen - 1
+                    pslice.base = base
+                    result.value = None
+
+                    try:
+                        # Call the grammar rule with our special stack view
+                        if plen:
+                            del statestack[-plen:]
+                        p.callable(pslice)
+
+                        # The symbol holding p[0] is pushed, with whatever
+                        # else the rule set on it.  The first symbol of the
+                        # production is popped and, emptied, holds p[0] for
+                        # the next rule, unless it is a token
+                        sym = result
+                        sym.type = pname       # Production name
+                        if plen:
+                            result = symstack[base+1]
+                            del symstack[base+1:]
+                            if result.__class__ is YaccSymbol:
+                                result.__dict__.clear()
+                            else:
+                                result = YaccSymbol()
+                        else:
+                            result = YaccSymbol()
+                        pslice.result = result
+                        symstack.append(sym)
+                        state = goto[statestack[-1]][pname]
+                        statestack.append(state)
+                    except SyntaxError:
+                        # If an error was set. Enter error recovery state
+                        result.__dict__.clear()
+                        del symstack[base+1:]
+                        lookaheadstack.append(lookahead)
+                        symstack.pop()
+                        statestack.pop()
+                        state = statestack[-1]
+                        sym = YaccSymbol()
+                        sym.type = 'error'
+                        sym.value = None
+                        lookahead = sym
+                        errorcount = error_count
+                        self.errorok = 0
+                    continue
+
+                if t == 0:
+                    n = symstack[-1]
+                    self.pushresult = getattr(n,"value",None)
+                    self.pushdone = 1
+                    return
+
+            if t == None:
+
+                # We have some kind of parsing error here.  See the comments
+                # in parseopt_notrack().  The token() function is not
+                # available to p_error() here, since tokens are pushed.
+                if errorcount == 0 or self.errorok:
+                    errorcount = error_count
+                    self.errorok = 0
+                    errtoken = lookahead
+                    if errtoken.type == '$end':
+                        errtoken = None               # End of file!
+                    if self.errorfunc:
+                        global errok,restart
+                        errok = self.errok        # Set some special functions available in error recovery
+                        restart = self.restart
+                        if errtoken and not hasattr(errtoken,'lexer'):
+                            errtoken.lexer = pslice.lexer
+                        tok = self.errorfunc(errtoken)
+                        del errok, restart        # Delete special functions
+
+                        if self.errorok:
+                            # User must have done some kind of panic
+                            # mode recovery on their own.  The
+                            # returned token is the next lookahead
+                            lookahead = tok
+                            state = statestack[-1]
+                            continue
+                    else:
+                        if errtoken:
+                            if hasattr(errtoken,"lineno"): lineno = lookahead.lineno
+                            else: lineno = 0
+                            if lineno:
+                                sys.stderr.write("yacc: Syntax error at line %d, token=%s\n" % (lineno, errtoken.type))
+                            else:
+                                sys.stderr.write("yacc: Syntax error, token=%s" % errtoken.type)
+                        else:
+                            sys.stderr.write("yacc: Parse error in input. EOF\n")
+                            self.pushdone = 1
+                            return
+
+                else:
+                    errorcount = error_count
+
+                # case 1:  the statestack only has 1 entry on it.  The token
+                # is discarded and we just keep going.
+
+                if len(statestack) <= 1 and lookahead.type != '$end':
+                    lookahead = None
+                    state = 0
+                    # Nuke the pushback stack
+                    del lookaheadstack[:]
+                    continue
+
+                # case 2: the statestack has a couple of entries on it, but we're
+                # at the end of the file. nuke the top entry and generate an error token
+
+                # Start nuking entries on the stack
+                if lookahead.type == '$end':
+                    # Whoa. We're really hosed here. Bail out
+                    self.pushdone = 1
+                    return
+
                 if lookahead.type != 'error':
                     sym = symstack[-1]
                     if sym.type == 'error':
@@ -1113,6 +1700,177 @@ class LRParser:
             # Call an error function here
             raise RuntimeError("yacc: internal parser error!!!\n")
 
+    def push_end(self):
+        if not self.pushdone:
+            sym = YaccSymbol()
+            sym.type = '$end'
+            self.push(sym)
+        return self.pushresult
+
+    # -----------------------------------------------------------------------------
+    # write_module()
+    #
+    # Writes a parser specialized for this grammar as a Python module.  The
+    # module has one function, bind(parser), which takes an LRParser built
+    # from the same grammar and returns a parse(lexer,tokenfunc=None)
+    # function.  Each production gets its own reduction code, with its
+    # length and goto table as constants, and the rules that only copy a
+    # value (p[0] = p[n]) or do nothing are inlined instead of called.  The
+    # other rules are the ones bound when bind() is called, and bind() checks
+    # that the inlined rules still copy the same value or still do nothing.
+    #
+    # The specialized parser does no error recovery: grammars using the
+    # error token are rejected.  On a syntax error, the error function is
+    # called and parse() returns None.  A SyntaxError raised by a rule is
+    # not caught.
+    # -----------------------------------------------------------------------------
+
+    def write_module(self,modulename,outputdir=''):
+        for row in self.action.values():
+            if 'error' in row:
+                raise YaccError("Grammars using the error token can't be specialized")
+
+        nstates = max(self.action) + 1
+        nonterminals = [ ]
+        for p in self.productions[1:]:
+            if p.name not in nonterminals:
+                nonterminals.append(p.name)
+        gotoid = dict([(name,i) for i,name in enumerate(nonterminals)])
+        gotos = [ { } for name in nonterminals ]
+        for state, row in self.goto.items():
+            for name, v in row.items():
+                gotos[gotoid[name]][state] = v
+
+        basemodulename = modulename.split(".")[-1]
+        filename = os.path.join(outputdir,basemodulename) + ".py"
+
+        out = [ ]
+        out.append("# %s" % filename)
+        out.append("# This file is automatically generated. Do not edit.")
+        out.append("import sys")
+        out.append("")
+        out.append("_tabversion = %r" % __tabversion__)
+        out.append("")
+        out.append("_productions = (")
+        for p in self.productions:
+            out.append("    %r," % p.str)
+        out.append(")")
+        out.append("")
+        out.append("_action = [")
+        for state in range(nstates):
+            out.append("    %r," % self.action.get(state,{}))
+        out.append("]")
+        out.append("")
+        for i, name in enumerate(nonterminals):
+            out.append("_goto_%d = %r    # %s" % (i,gotos[i],name))
+        out.append("")
+        inlined = { }
+        for n, p in enumerate(self.productions):
+            if n == 0:
+                continue
+            inlined[n] = _inlined_rule(p.callable,p.len)
+
+        out.append("_inlined = {")
+        for n in sorted(inlined):
+            if inlined[n] is not None:
+                out.append("    %d: %d,    # %s" % (n,inlined[n],self.productions[n].str))
+        out.append("}")
+        out.append("")
+        out.append("def bind(parser):")
+        out.append("    if tuple([p.str for p in parser.productions]) != _productions:")
+        out.append("        raise ValueError('The parser was built from another grammar')")
+        out.append("")
+        out.append("    yacc = sys.modules[parser.__class__.__module__]")
+        out.append("    for n, copied in _inlined.items():")
+        out.append("        p = parser.productions[n]")
+        out.append("        if yacc._inlined_rule(p.callable,p.len) != copied:")
+        out.append("            raise ValueError('The rule of %s does not match the inlined code' % p.str)")
+        out.append("")
+        out.append("    YaccSymbol = yacc.YaccSymbol")
+        out.append("    YaccProduction = yacc.YaccProduction")
+        out.append("    errorfunc = parser.errorfunc")
+        out.append("    action = _action")
+
+        for n, p in enumerate(self.productions):
+            if n == 0:
+                continue
+            if inlined[n] is None:
+                out.append("    rule_%d = parser.productions[%d].callable" % (n,n))
+        for i in range(len(nonterminals)):
+            out.append("    goto_%d = _goto_%d" % (i,i))
+        out.append("")
+        out.append("    def parse(lexer,tokenfunc=None):")
+        out.append("        get_token = tokenfunc or lexer.token")
+        out.append("        pslice = YaccProduction(None)")
+        out.append("        pslice.lexer = lexer")
+        out.append("        pslice.parser = parser")
+        out.append("        end = YaccSymbol()")
+        out.append("        end.type = '$end'")
+        out.append("        statestack = [ 0 ]")
+        out.append("        symstack = [ end ]")
+        out.append("        pslice.stack = symstack")
+        out.append("        state = 0")
+        out.append("        lookahead = get_token() or end")
+        out.append("        ltype = lookahead.type")
+        out.append("        while 1:")
+        out.append("            t = action[state].get(ltype)")
+        out.append("            if t is None:")
+        out.append("                if errorfunc:")
+        out.append("                    if lookahead is end:")
+        out.append("                        errorfunc(None)")
+        out.append("                    else:")
+        out.append("                        if not hasattr(lookahead,'lexer'):")
+        out.append("                            lookahead.lexer = lexer")
+        out.append("                        errorfunc(lookahead)")
+        out.append("                return None")
+        out.append("            if t > 0:")
+        out.append("                statestack.append(t)")
+        out.append("                state = t")
+        out.append("                symstack.append(lookahead)")
+        out.append("                lookahead = get_token() or end")
+        out.append("                ltype = lookahead.type")
+        out.append("                continue")
+        keyword = "if"
+        for n, p in enumerate(self.productions):
+            if n == 0:
+                continue
+            out.append("            %s t == %d:    # %s" % (keyword,-n,p.str))
+            keyword = "elif"
+            out.append("                sym = YaccSymbol()")
+            out.append("                sym.type = %r" % p.name)
+            copied = inlined[n]
+            if copied is None:
+                out.append("                sym.value = None")
+                if p.len:
+                    out.append("                targ = symstack[%d:]" % (-p.len-1))
+                    out.append("                targ[0] = sym")
+                else:
+                    out.append("                targ = [ sym ]")
+                out.append("                pslice.slice = targ")
+            elif copied:
+                out.append("                sym.value = symstack[%d].value" % (copied-p.len-1))
+            else:
+                out.append("                sym.value = None")
+            if p.len:
+                out.append("                del symstack[%d:]" % -p.len)
+                out.append("                del statestack[%d:]" % -p.len)
+            if copied is None:
+                out.append("                rule_%d(pslice)" % n)
+            out.append("                state = goto_%d[statestack[-1]]" % gotoid[p.name])
+        out.append("            else:")
+        out.append("                return getattr(symstack[-1],'value',None)")
+        out.append("            symstack.append(sym)")
+        out.append("            statestack.append(state)")
+        out.append("")
+        out.append("    return parse")
+        out.append("")
+
+        f = open(filename,"w")
+        try:
+            f.write("\n".join(out))
+        finally:
+            f.close()
+
 # -----------------------------------------------------------------------------
 #                          === Grammar Representation ===
 #
@@ -1811,6 +2569,46 @@ class Grammar(object):
 
 class VersionError(YaccError): pass
 
+# Conversions between arrays and the bytes written to table files
+def _array_to_bytes(a):
+    if hasattr(a,"tobytes"):
+        return a.tobytes()
+    return a.tostring()
+
+def _array_from_bytes(typecode,data,byteorder):
+    a = array(typecode)
+    if hasattr(a,"frombytes"):
+        a.frombytes(data)
+    else:
+        a.fromstring(data)
+    if byteorder != sys.byteorder:
+        a.byteswap()
+    return a
+
+# Packs a {state: {symbol: value}} table into three integer arrays: the
+# offset of each state's row, then the symbol id and the value of each entry
+def _pack_rows(table,symbols,nstates):
+    symbolid = dict([(name,i) for i,name in enumerate(symbols)])
+    offsets = array('i',[0])
+    columns = array('i')
+    values = array('i')
+    for state in range(nstates):
+        row = table.get(state,{})
+        entries = sorted([(symbolid[name],v) for name,v in row.items()])
+        columns.extend([c for c,v in entries])
+        values.extend([v for c,v in entries])
+        offsets.append(len(columns))
+    return (_array_to_bytes(offsets),_array_to_bytes(columns),_array_to_bytes(values))
+
+def _unpack_rows(packed,symbols,byteorder):
+    offsets, columns, values = [_array_from_bytes('i',data,byteorder) for data in packed]
+    name = symbols.__getitem__
+    rows = { }
+    for state in range(len(offsets) - 1):
+        start, end = offsets[state], offsets[state + 1]
+        rows[state] = dict(zip(map(name,columns[start:end]),values[start:end]))
+    return rows
+
 class LRTable(object):
     def __init__(self):
         self.lr_action = None
@@ -1866,6 +2664,76 @@ class LRTable(object):
         in_f.close()
         return signature
 
+    # -----------------------------------------------------------------------------
+    # read_binary()
+    #
+    # Reads the tables written by write_binary().  Symbols are numbered by
+    # their position in the lists of terminals and nonterminals, and the
+    # action and goto tables are stored as arrays of integers.
+    # -----------------------------------------------------------------------------
+
+    def read_binary(self,filename):
+        in_f = open(filename,"rb")
+        try:
+            tables = marshal.load(in_f)
+        finally:
+            in_f.close()
+
+        if tables[0] != __tabversion__:
+            raise VersionError("yacc table file version is out of date")
+
+        (self.lr_method, signature, byteorder, terminals, nonterminals,
+         action, goto, productions) = tables[1:]
+
+        self.lr_terminals = terminals
+        self.lr_nonterminals = nonterminals
+        self.lr_action = _unpack_rows(action,terminals,byteorder)
+        self.lr_goto = _unpack_rows(goto,nonterminals,byteorder)
+
+        self.lr_productions = []
+        for p in productions:
+            self.lr_productions.append(MiniProduction(*p))
+
+        return signature
+
+    # -----------------------------------------------------------------------------
+    # write_binary()
+    #
+    # Writes the LR parsing tables to a file in a compact binary format, loaded
+    # by read_binary() without importing or unpickling any Python code.
+    # -----------------------------------------------------------------------------
+
+    def write_binary(self,filename,signature=""):
+        terminals = { }
+        for row in self.lr_action.values():
+            terminals.update(row)
+        terminals = sorted(terminals)
+
+        nonterminals = { }
+        for row in self.lr_goto.values():
+            nonterminals.update(row)
+        nonterminals = sorted(nonterminals)
+
+        nstates = max(self.lr_action) + 1
+        action = _pack_rows(self.lr_action,terminals,nstates)
+        goto = _pack_rows(self.lr_goto,nonterminals,nstates)
+
+        productions = []
+        for p in self.lr_productions:
+            if p.func:
+                productions.append((p.str,p.name,p.len,p.func,p.file,p.line))
+            else:
+                productions.append((str(p),p.name,p.len,None,None,None))
+
+        tables = (__tabversion__, self.lr_method, signature, sys.byteorder, terminals, nonterminals,
+                  action, goto, productions)
+
+        outf = open(filename,"wb")
+        try:
+            marshal.dump(tables,outf)
+        finally:
+            outf.close()
+
     # Bind all production function names to callable objects in pdict
     def bind_callables(self,pdict):
         for p in self.lr_productions:
@@ -3035,13 +3903,13 @@ class ParserReflect(object):
 
 def yacc(method='LALR', debug=yaccdebug, module=None, tabmodule=tab_module, start=None, 
          check_recursion=1, optimize=0, write_tables=1, debugfile=debug_file,outputdir='',
-         debuglog=None, errorlog = None, picklefile=None):
+         debuglog=None, errorlog = None, picklefile=None, binfile=None):
 
     global parse                 # Reference to the parsing method of the last built parser
 
-    # If pickling is enabled, table files are not created
+    # If pickling or binary tables are enabled, table files are not created
 
-    if picklefile:
+    if picklefile or binfile:
         write_tables = 0
 
     if errorlog is None:
@@ -3067,7 +3935,9 @@ def yacc(method='LALR', debug=yaccdebug, module=None, tabmodule=tab_module, star
     # Read the tables
     try:
         lr = LRTable()
-        if picklefile:
+        if binfile:
+            read_signature = lr.read_binary(binfile)
+        elif picklefile:
             read_signature = lr.read_pickle(picklefile)
         else:
             read_signature = lr.read_table(tabmodule)
@@ -3268,6 +4138,14 @@ def yacc(method='LALR', debug=yaccdebug, module=None, tabmodule=tab_module, star
     if picklefile:
         lr.pickle_table(picklefile,signature)
 
+    # Write a binary version of the tables
+    if binfile:
+        try:
+            lr.write_binary(binfile,signature)
+        except IOError:
+            e = sys.exc_info()[1]
+            errorlog.warning("Couldn't create %r. %s" % (binfile, e))
+
     # Build the parser
     lr.bind_callables(pinfo.pdict)
     parser = LRParser(lr,pinfo.error_func)